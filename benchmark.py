@@ -0,0 +1,137 @@
+import statistics
+import time
+import warnings
+warnings.filterwarnings("ignore")
+
+import pandas as pd
+from sqlalchemy import text
+
+from findy.interface import Region, EntityType
+from findy.database.schema import IntervalLevel
+from findy.database.context import get_db_session
+from findy.database.partition import is_partitioned
+from findy.database.persist import get_saved_ids
+from findy.database.quote import get_kdata_schema
+
+# the synthetic entities, and the first day of their records
+bench_prefix = 'stock_bench_'
+bench_epoch = pd.Timestamp('1970-01-01')
+
+
+def arg_parsing():
+    import argparse
+
+    # parse cli args
+    parser = argparse.ArgumentParser(description="time get_saved_ids of each dedup_mode against a table of growing size, "
+                                                 "the synthetic rows are inserted in one transaction which is rolled back")
+
+    parser.add_argument("-region",
+                        choices=[e.value for e in Region],
+                        default=Region.US.value,
+                        help=f"database region. support: {[e.value for e in Region]}")
+
+    parser.add_argument("-level",
+                        choices=[e.value for e in IntervalLevel],
+                        default=IntervalLevel.LEVEL_1DAY.value,
+                        help="level of the stock kdata table to benchmark")
+
+    parser.add_argument("-sizes",
+                        type=int,
+                        nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help="synthetic rows of the table at each step")
+
+    parser.add_argument("-entities",
+                        type=int,
+                        default=500,
+                        help="synthetic entities the rows are spread over")
+
+    parser.add_argument("-window",
+                        type=int,
+                        default=250,
+                        help="rows of the incoming frame, half of them already saved")
+
+    parser.add_argument("-repeat",
+                        type=int,
+                        default=20,
+                        help="timed calls per dedup_mode and size")
+
+    return parser.parse_args()
+
+
+class BenchEntity(object):
+    def __init__(self, entity_id: str) -> None:
+        self.id = entity_id
+
+
+def insert_days(db_session, tablename: str, entities: int, start: int, end: int):
+    """
+    insert the days [start, end) since bench_epoch of every synthetic entity
+    """
+    db_session.execute(text(
+        f"insert into {tablename} (id, entity_id, timestamp, code, open, close, high, low, volume) "
+        f"select e.entity_id || '_' || to_char(d.day, 'YYYY-MM-DD'), e.entity_id, d.day, e.code, 1, 1, 1, 1, 1 "
+        f"from (select '{bench_prefix}' || i as entity_id, 'BENCH' || i as code "
+        f"      from generate_series(0, :entities - 1) i) e "
+        f"cross join (select timestamp '{bench_epoch:%Y-%m-%d}' + make_interval(days => n) as day "
+        f"            from generate_series(:start, :end - 1) n) d"),
+        {'entities': entities, 'start': start, 'end': end})
+
+
+def incoming_frame(entity_id: str, days: int, window: int) -> pd.DataFrame:
+    # the last half window saved days of the entity followed by half a window of new ones
+    first = days - window // 2
+    timestamps = pd.date_range(bench_epoch + pd.Timedelta(days=first), periods=window, freq='D')
+    return pd.DataFrame({'id': [f'{entity_id}_{ts:%Y-%m-%d}' for ts in timestamps],
+                         'entity_id': entity_id,
+                         'timestamp': timestamps})
+
+
+def bench(args):
+    region = Region(args.region)
+    data_schema = get_kdata_schema(EntityType.Stock, level=args.level)
+    if data_schema is None or not data_schema.providers.get(region):
+        print(f"no stock kdata of level {args.level} in region {region.value}")
+        return
+
+    tablename = data_schema.__tablename__
+    provider = data_schema.providers[region][0]
+    db_session = get_db_session(region, provider, data_schema, force_new=True)
+    if is_partitioned(db_session.get_bind(), tablename):
+        db_session.close()
+        print(f"{tablename} is partitioned, choose a level which is not")
+        return
+    entity = BenchEntity(f'{bench_prefix}0')
+
+    print(f"table: {tablename}, entities: {args.entities}, window: {args.window}, repeat: {args.repeat}")
+    print(f"{'rows':>10} {'rows/entity':>12} {'mode':>8} {'saved':>7} {'median ms':>10} {'p90 ms':>10}")
+
+    days = 0
+    try:
+        for size in sorted(args.sizes):
+            total_days = max(size // args.entities, 1)
+            if total_days > days:
+                insert_days(db_session, tablename, args.entities, days, total_days)
+                days = total_days
+                # the planner should see the table at its size
+                db_session.execute(text(f"analyze {tablename}"))
+
+            df = incoming_frame(entity.id, days, args.window)
+            for dedup_mode in ['ids', 'window', 'full']:
+                costs = []
+                for _ in range(args.repeat):
+                    now = time.perf_counter()
+                    saved = get_saved_ids(region, provider, data_schema, db_session, df,
+                                          ref_entity=entity, dedup_mode=dedup_mode)
+                    costs.append((time.perf_counter() - now) * 1000)
+
+                p90 = statistics.quantiles(costs, n=10)[8] if len(costs) > 1 else costs[0]
+                print(f"{days * args.entities:>10} {days:>12} {dedup_mode:>8} {len(saved):>7} "
+                      f"{statistics.median(costs):>10.3f} {p90:>10.3f}")
+    finally:
+        db_session.rollback()
+        db_session.close()
+
+
+if __name__ == '__main__':
+    bench(arg_parsing())
@@ -81,6 +81,14 @@ def init_env(findy_home: str, **kwargs) -> dict:
     findy_env['out_path'] = os.path.join(findy_home, 'out')
     os.makedirs(findy_env['out_path'], exist_ok=True)
 
+    # path for the parquet mirrors of db tables
+    findy_env['mirror_path'] = os.path.join(findy_home, 'mirror')
+    os.makedirs(findy_env['mirror_path'], exist_ok=True)
+
+    # path for the memory mapped panel stores
+    findy_env['panel_path'] = os.path.join(findy_home, 'panel')
+    os.makedirs(findy_env['panel_path'], exist_ok=True)
+
     # path for 3th-party source
     findy_env['source_path'] = os.path.join(findy_home, 'source')
     os.makedirs(findy_env['source_path'], exist_ok=True)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+from sqlalchemy.ext.declarative import DeclarativeMeta
+
+from findy import findy_config
+from findy.interface import Region
+from findy.database.context import get_db_engine, secondary_indexes, BACKFILL_MARK
+from findy.database.partition import is_partitioned
+from findy.utils.time import PRECISION_STR
+
+logger = logging.getLogger(__name__)
+
+
+def autocommit(engine):
+    return engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def is_backfilling(connection, tablename: str) -> bool:
+    comment = connection.execute(text("select obj_description(to_regclass(:t), 'pg_class')"),
+                                 {'t': tablename}).scalar()
+    return comment == BACKFILL_MARK
+
+
+def is_empty(connection, tablename: str) -> bool:
+    return connection.execute(text(f"select 1 from {tablename} limit 1")).first() is None
+
+
+def begin_backfill(region: Region, data_schema: DeclarativeMeta):
+    """
+    drop the secondary indexes and mark the table, so COPY loads into the bare table,
+    the table is switched to UNLOGGED as well if backfill_unlogged is set
+    """
+    table = data_schema.__table__
+
+    engine = get_db_engine(region)
+    partitioned = is_partitioned(engine, table.name)
+
+    with autocommit(engine) as connection:
+        connection.execute(text(f"comment on table {table.name} is '{BACKFILL_MARK}'"))
+
+        for index_name, _ in secondary_indexes(table):
+            connection.execute(text(f"drop index if exists {index_name}"))
+
+        # partitioned tables could not be switched as a whole
+        if findy_config.get('backfill_unlogged', False) and not partitioned:
+            connection.execute(text(f"alter table {table.name} set unlogged"))
+
+    logger.info(f'begin backfill on table: [ {table.name} ]')
+
+
+def create_secondary_index(engine, tablename: str, index_name: str, col: str):
+    order = ' desc' if col == 'timestamp' else ''
+    with autocommit(engine) as connection:
+        connection.execute(text(f"set maintenance_work_mem = '{findy_config.get('backfill_index_memory', '256MB')}'"))
+        connection.execute(text(f'create index if not exists {index_name} on {tablename} ("{col}"{order})'))
+
+
+def end_backfill(region: Region, data_schema: DeclarativeMeta):
+    """
+    rebuild the secondary indexes in parallel, switch the table back to LOGGED,
+    ANALYZE it and remove the backfill mark
+    """
+    now = time.time()
+    table = data_schema.__table__
+    engine = get_db_engine(region)
+
+    indexes = secondary_indexes(table)
+    workers = max(1, min(len(indexes), findy_config.get('backfill_index_workers', 4)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(create_secondary_index, engine, table.name, index_name, col)
+                   for index_name, col in indexes]
+        [future.result() for future in futures]
+
+    partitioned = is_partitioned(engine, table.name)
+
+    with autocommit(engine) as connection:
+        if not partitioned:
+            persistence = connection.execute(text("select relpersistence from pg_class where oid = to_regclass(:t)"),
+                                             {'t': table.name}).scalar()
+            if persistence == 'u':
+                connection.execute(text(f"alter table {table.name} set logged"))
+
+        connection.execute(text(f"analyze {table.name}"))
+        connection.execute(text(f"comment on table {table.name} is null"))
+
+    cost = PRECISION_STR.format(time.time() - now)
+    logger.info(f'end backfill on table: [ {table.name} ], indexes: {len(indexes)}, cost: {cost}')
+
+
+def prepare_backfill(region: Region, data_schema: DeclarativeMeta) -> bool:
+    """
+    enter backfill mode if the table is empty, returns whether the run is a backfill
+
+    a backfill interrupted before end_backfill leaves the mark on a loaded table,
+    it is finished here first so the following run queries indexed data
+    """
+    if not findy_config.get('backfill', True):
+        return False
+
+    tablename = data_schema.__tablename__
+    with autocommit(get_db_engine(region)) as connection:
+        backfilling = is_backfilling(connection, tablename)
+        empty = is_empty(connection, tablename)
+
+    if empty:
+        if not backfilling:
+            begin_backfill(region, data_schema)
+        return True
+
+    if backfilling:
+        logger.warning(f'finish interrupted backfill on table: [ {tablename} ]')
+        end_backfill(region, data_schema)
+
+    return False
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from concurrent.futures import Future
+from multiprocessing import util
+
+import pandas as pd
+from sqlalchemy.ext.declarative import DeclarativeMeta
+
+from findy import findy_config
+from findy.interface import Region, Provider
+from findy.database.schema.register import get_schema_columns
+from findy.database.context import get_db_session
+from findy.database.persist import get_saved_ids, saved_rows, to_postgresql
+from findy.utils.time import PRECISION_STR
+
+logger = logging.getLogger(__name__)
+
+# (region, tablename) -> WriteBuffer
+__write_buffers = {}
+
+
+class WriteBuffer(object):
+    """
+    per table write-behind buffer, coalesce the small frames pushed by recorders into one large COPY
+
+    push returns a Future which resolves to the saved counts of the pushed frame once it is flushed
+    """
+
+    def __init__(self,
+                 region: Region,
+                 provider: Provider,
+                 data_schema: DeclarativeMeta,
+                 max_rows: int,
+                 max_bytes: int,
+                 max_age: float,
+                 copy_format: str = 'csv') -> None:
+        self.region = region
+        self.provider = provider
+        self.data_schema = data_schema
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.copy_format = copy_format
+
+        self.pending = []
+        self.rows = 0
+        self.bytes = 0
+        self.since = None
+
+    def push(self, df: pd.DataFrame) -> Future:
+        future = Future()
+        self.pending.append((df, future))
+
+        self.rows += len(df)
+        self.bytes += int(df.memory_usage(index=False, deep=True).sum())
+        if self.since is None:
+            self.since = time.time()
+
+        if self.rows >= self.max_rows or \
+           self.bytes >= self.max_bytes or \
+           time.time() - self.since >= self.max_age:
+            self.flush()
+
+        return future
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+
+        now = time.time()
+        pending = self.pending
+        self.pending = []
+        self.rows = 0
+        self.bytes = 0
+        self.since = None
+
+        counts = [0] * len(pending)
+        saved = 0
+
+        try:
+            # level 0 of the index keeps the position of the pushed frame
+            df = pd.concat([item[0] for item in pending], keys=range(len(pending)))
+            df = df[~df.duplicated(subset='id', keep='last')]
+
+            cols = list(set(df.columns.tolist()) & set(get_schema_columns(self.data_schema)))
+            df = df[cols]
+
+            db_session = get_db_session(self.region, self.provider, self.data_schema)
+            ref_ids = get_saved_ids(self.region, self.provider, self.data_schema, db_session, df)
+            if ref_ids:
+                df = df[~df.id.isin(ref_ids)]
+
+            bad_rows = []
+            if len(df) > 0:
+                saved = to_postgresql(self.region, df, self.data_schema.__tablename__,
+                                      copy_format=self.copy_format, data_schema=self.data_schema,
+                                      bad_rows=bad_rows)
+
+            # credit each frame with its rows which were not quarantined
+            if saved > 0:
+                df = saved_rows(df, bad_rows)
+                for index, count in df.index.get_level_values(0).value_counts().items():
+                    counts[index] = int(count)
+
+        except Exception as e:
+            logger.error(f'flush write buffer failed on table: [ {self.data_schema.__tablename__} ], {e}')
+
+        cost = PRECISION_STR.format(time.time() - now)
+        logger.debug(f"flush {self.data_schema.__tablename__}: {cost}, frames: {len(pending)}, size: {saved}")
+
+        for (_, future), count in zip(pending, counts):
+            future.set_result(count)
+
+        return saved
+
+
+def get_write_buffer(region: Region,
+                     provider: Provider,
+                     data_schema: DeclarativeMeta,
+                     copy_format: str = 'csv') -> WriteBuffer:
+    key = (region, data_schema.__tablename__)
+
+    write_buffer = __write_buffers.get(key)
+    if write_buffer is None:
+        # flush whatever is left when the worker process exits
+        if not __write_buffers:
+            util.Finalize(None, flush_write_buffers, exitpriority=10)
+
+        write_buffer = WriteBuffer(region, provider, data_schema,
+                                   max_rows=findy_config['write_buffer_rows'],
+                                   max_bytes=findy_config.get('write_buffer_bytes', 64 * 1024 * 1024),
+                                   max_age=findy_config.get('write_buffer_age', 30),
+                                   copy_format=copy_format)
+        __write_buffers[key] = write_buffer
+
+    return write_buffer
+
+
+def flush_write_buffers() -> int:
+    return sum(write_buffer.flush() for write_buffer in __write_buffers.values())
@@ -18,10 +18,15 @@ from sqlalchemy_batch_inserts import enable_batch_inserting
 from findy import findy_config
 from findy.interface import Region, Provider
 from findy.database.schema.register import get_db_name
+from findy.database.partition import ensure_partitions
+from findy.utils.time import now_pd_timestamp
 
 logger = logging.getLogger(__name__)
 logger_time = logging.getLogger("findy.sql.performance")
 
+# table comment of the tables in bulk backfill
+BACKFILL_MARK = 'findy:backfill'
+
 # provider_dbname -> engine
 __db_engine_map = {}
 
@@ -182,6 +187,24 @@ def get_db_engine(region: Region) -> Engine:
     return db_engine
 
 
+def reset_db_context():
+    """
+    forget the engines and sessions inherited from the parent process, so a forked worker
+    opens connections of its own, the inherited ones are left to the parent
+    """
+    __db_engine_map.clear()
+    __db_sessions.clear()
+
+
+def secondary_indexes(table):
+    """
+    (index name, column) of the single column indexes created on table
+    """
+    # for col in ['timestamp', 'entity_id', 'code', 'report_period', 'created_timestamp', 'updated_timestamp']:
+    return [(f'{table.name}_{col}_index', col)
+            for col in ['timestamp', 'entity_id', 'code', 'report_period'] if col in table.c]
+
+
 def create_index(region: Region, engine, schema_base):
     if not __dbname_map_index.get(region):
         __dbname_map_index[region] = []
@@ -202,26 +225,27 @@ def create_index(region: Region, engine, schema_base):
 
             logger.debug(f'create async index -> engine: {engine}, table: {table_name}, index: {index_column_names}')
 
-            # for col in ['timestamp', 'entity_id', 'code', 'report_period', 'created_timestamp', 'updated_timestamp']:
-            for col in ['timestamp', 'entity_id', 'code', 'report_period']:
-                if col in table.c:
-                    index_name = f'{table_name}_{col}_index'
-                    if index_name not in index_column_names:
-                        column = eval(f'table.c.{col}')
-                        if col == 'timestamp':
-                            column = eval(f'table.c.{col}.desc()')
-                        else:
-                            column = eval(f'table.c.{col}')
-                        # index = schema.Index(index_name, column, unique=(col=='id'))
-                        index = schema.Index(index_name, column)
-                        index.create(engine)
+            # secondary indexes are built once the backfill is loaded
+            if (inspector.get_table_comment(table_name) or {}).get('text') == BACKFILL_MARK:
+                logger.debug(f'skip index -> table: {table_name} is backfilling')
+                continue
+
+            for index_name, col in secondary_indexes(table):
+                if index_name not in index_column_names:
+                    if col == 'timestamp':
+                        column = table.c[col].desc()
+                    else:
+                        column = table.c[col]
+                    # index = schema.Index(index_name, column, unique=(col=='id'))
+                    index = schema.Index(index_name, column)
+                    index.create(engine)
 
             for cols in [('timestamp', 'entity_id'), ('timestamp', 'code')]:
                 if (cols[0] in table.c) and (col[1] in table.c):
                     index_name = f'{table_name}_{col[0]}_{col[1]}_index'
                     if index_name not in index_column_names:
-                        column0 = eval(f'table.c.{col[0]}')
-                        column1 = eval(f'table.c.{col[1]}')
+                        column0 = table.c[col[0]]
+                        column1 = table.c[col[1]]
                         index = schema.Index(index_name, column0, column1)
                         index.create(engine)
 
@@ -237,6 +261,10 @@ def bind_engine(region: Region,
     # create table
     schema_base.metadata.create_all(engine, checkfirst=True)
 
+    # create the partitions of the current period, later ones are created before COPY
+    for table in schema_base.metadata.tables.values():
+        ensure_partitions(engine, table, now_pd_timestamp(region), now_pd_timestamp(region))
+
     # create index
     create_index(region, engine, schema_base)
 
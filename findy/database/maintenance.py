@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from sqlalchemy import text
+
+from findy import findy_config
+from findy.interface import Region
+from findy.database.context import get_db_engine
+from findy.utils.time import PRECISION_STR
+
+logger = logging.getLogger(__name__)
+
+
+def stale_tables(connection, tablenames: list):
+    """
+    (tablename, action) of tablenames, or of their partitions, changed enough since their last ANALYZE / VACUUM,
+
+    the rows written by all recorder processes are counted by postgresql itself in
+    pg_stat_user_tables, n_mod_since_analyze for ANALYZE and n_dead_tup for VACUUM
+    """
+    analyze_fraction = findy_config.get('maintenance_analyze_fraction', 0.05)
+    vacuum_fraction = findy_config.get('maintenance_vacuum_fraction', 0.1)
+    min_rows = findy_config.get('maintenance_min_rows', 10000)
+
+    rows = connection.execute(text(
+        "select s.relname, s.n_live_tup, s.n_dead_tup, s.n_mod_since_analyze from pg_stat_user_tables s "
+        "where s.relname = any(:tables) or exists (select 1 from pg_inherits i "
+        "where i.inhrelid = s.relid and i.inhparent = any(array(select to_regclass(t) from unnest(:tables) t)))"),
+        {'tables': list(tablenames)}).fetchall()
+
+    tables = []
+    for tablename, live, dead, modified in rows:
+        if dead > min_rows + vacuum_fraction * live:
+            tables.append((tablename, 'vacuum (analyze, skip_locked)'))
+        elif modified > min_rows + analyze_fraction * live:
+            tables.append((tablename, 'analyze (skip_locked)'))
+    return tables
+
+
+def maintain_tables(region: Region, tablenames: list) -> int:
+    """
+    ANALYZE, or VACUUM (ANALYZE) the tables of tablenames with many rows written,
+    returns the maintained table counts
+    """
+    if not findy_config.get('maintenance', True) or not tablenames:
+        return 0
+
+    engine = get_db_engine(region)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        tables = stale_tables(connection, tablenames)
+
+        for tablename, action in tables:
+            now = time.time()
+            try:
+                connection.execute(text(f'{action} "{tablename}"'))
+            except Exception as e:
+                logger.warning(f'{action} on table: [ {tablename} ] failed, {e}')
+                continue
+
+            cost = PRECISION_STR.format(time.time() - now)
+            logger.info(f'{action} on table: [ {tablename} ], cost: {cost}')
+
+    return len(tables)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import select, values, column, String, DateTime
+from sqlalchemy.ext.declarative import DeclarativeMeta
+
+from findy import findy_config, findy_env
+from findy.interface import Region
+from findy.database.context import get_db_session
+from findy.database.statement import get_schema_column
+from findy.database.watermark import get_latest_timestamps
+from findy.utils.time import PRECISION_STR, to_pd_timestamp
+
+logger = logging.getLogger(__name__)
+
+# lower bound of the entities never mirrored
+epoch = datetime(1900, 1, 1)
+
+
+def mirror_path(region: Region, tablename: str) -> str:
+    return os.path.join(findy_env['mirror_path'], region.value, tablename)
+
+
+def entity_bucket(entity_id: str, buckets: int) -> int:
+    return zlib.crc32(entity_id.encode('utf-8')) % buckets
+
+
+def load_state(path: str) -> dict:
+    """
+    entity_id -> latest timestamp mirrored
+    """
+    try:
+        with open(os.path.join(path, '_state.json')) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {'buckets': findy_config.get('mirror_buckets', 16), 'entities': {}}
+    state['entities'] = {entity_id: pd.Timestamp(ts) for entity_id, ts in state['entities'].items()}
+    return state
+
+
+def save_state(path: str, state: dict):
+    tmp = os.path.join(path, '_state.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'buckets': state['buckets'],
+                   'entities': {entity_id: ts.isoformat() for entity_id, ts in state['entities'].items()}}, f)
+    os.replace(tmp, os.path.join(path, '_state.json'))
+
+
+def mirror_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('year', pa.int32()), ('bucket', pa.int32())]), flavor='hive')
+
+
+def write_mirror(path: str, df: pd.DataFrame, buckets: int):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    df = df.sort_values(['entity_id', 'timestamp'])
+    df['year'] = df['timestamp'].dt.year.astype('int32')
+    df['bucket'] = df['entity_id'].map(lambda entity_id: entity_bucket(entity_id, buckets)).astype('int32')
+
+    # rows sorted by entity and time keep the row group statistics narrow for pruning
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False),
+                     path,
+                     format='parquet',
+                     partitioning=mirror_partitioning(),
+                     basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore',
+                     max_rows_per_group=findy_config.get('mirror_row_group_rows', 64 * 1024))
+
+
+def compact_mirror(path: str, min_files: int = None) -> int:
+    """
+    merge the files of every year and bucket partition of the mirror at path with at least min_files
+    files into one, sorted by entity and time, returns the partitions compacted
+
+    every sync adds a file to each partition it touches, so they would pile up unbounded, the merged file
+    is renamed into place before the merged ones are removed, a concurrent reader may see both meanwhile
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    min_files = max(min_files or findy_config.get('mirror_compact_files', 8), 2)
+    compacted = 0
+    for root, _, files in os.walk(path):
+        parts = sorted(f for f in files if f.startswith('part-') and f.endswith('.parquet'))
+        if len(parts) < min_files:
+            continue
+
+        df = pd.concat([pq.read_table(os.path.join(root, f), partitioning=None).to_pandas() for f in parts],
+                       ignore_index=True)
+        df = df[~df.duplicated(subset='id', keep='last')].sort_values(['entity_id', 'timestamp'])
+
+        # _ prefixed files are skipped by the readers until renamed
+        name = f'part-{uuid.uuid4().hex}-0.parquet'
+        tmp = os.path.join(root, f'_{name}')
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp,
+                       row_group_size=findy_config.get('mirror_row_group_rows', 64 * 1024))
+        os.replace(tmp, os.path.join(root, name))
+        for f in parts:
+            os.remove(os.path.join(root, f))
+        compacted += 1
+
+    return compacted
+
+
+def sync_mirror(region: Region, data_schema: DeclarativeMeta) -> int:
+    """
+    append the rows saved since the last sync of data_schema to its parquet mirror,
+    partitioned by year and entity bucket, returns the appended row counts
+
+    the entities to sync and their new ranges come from the watermark catalog,
+    rows rewritten with an older timestamp are not picked up, remove the mirror to resync it
+    """
+    from findy.database.persist import from_postgresql
+
+    now = time.time()
+    tablename = data_schema.__tablename__
+    path = mirror_path(region, tablename)
+    os.makedirs(path, exist_ok=True)
+
+    state = load_state(path)
+    mirrored = state['entities']
+
+    provider = data_schema.providers[region][0]
+    db_session = get_db_session(region, provider, data_schema)
+    latest = get_latest_timestamps(db_session, tablename)
+
+    stale = sorted(entity_id for entity_id, ts in latest.items()
+                   if entity_id not in mirrored or ts > mirrored[entity_id])
+
+    entity_col = get_schema_column(data_schema, 'entity_id')
+    time_col = get_schema_column(data_schema, 'timestamp')
+    cols = [get_schema_column(data_schema, col.key) for col in data_schema.__table__.columns]
+
+    batch = findy_config.get('mirror_batch_entities', 500)
+    saved = 0
+    for i in range(0, len(stale), batch):
+        entity_ids = stale[i:i + batch]
+        since = values(column('entity_id', String), column('since', DateTime), name='since').data(
+            [(entity_id, mirrored.get(entity_id, pd.Timestamp(epoch)).to_pydatetime()) for entity_id in entity_ids])
+        statement = select(*cols).join(since, entity_col == since.c.entity_id).where(time_col > since.c.since)
+
+        df = from_postgresql(region, statement)
+        if df is None:
+            logger.error(f'sync mirror of table: [ {tablename} ] failed')
+            break
+
+        df = df[df['timestamp'].notna()]
+        if len(df) > 0:
+            write_mirror(path, df, state['buckets'])
+            saved += len(df)
+
+            for entity_id, ts in df.groupby('entity_id')['timestamp'].max().items():
+                mirrored[entity_id] = ts
+            save_state(path, state)
+
+    compacted = compact_mirror(path) if saved > 0 else 0
+
+    cost = PRECISION_STR.format(time.time() - now)
+    logger.info(f'sync mirror of table: [ {tablename} ], entities: {len(stale)}, rows: {saved}, '
+                f'compacted: {compacted}, cost: {cost}')
+    return saved
+
+
+def sync_mirrors(region: Region, tablename: str = None) -> int:
+    """
+    sync the parquet mirrors of the tables listed in the mirror config, only the one of tablename if set
+    """
+    from findy.database.schema.register import get_schemas
+
+    tablenames = set(findy_config.get('mirror', []))
+    if tablename is not None:
+        tablenames &= {tablename}
+
+    saved = 0
+    for data_schema in get_schemas(region):
+        # schemas are registered once per provider
+        if data_schema.__tablename__ not in tablenames:
+            continue
+        tablenames.discard(data_schema.__tablename__)
+
+        try:
+            saved += sync_mirror(region, data_schema)
+        except Exception as e:
+            logger.error(f'sync mirror of table: [ {data_schema.__tablename__} ] failed, {e}')
+    return saved
+
+
+def mirror_coverage(region: Region, data_schema: DeclarativeMeta, entity_ids=None):
+    """
+    (timestamp all the mirrored entities of entity_ids are synced until, entity_ids not mirrored),
+    the timestamp is None if none of them is mirrored
+    """
+    mirrored = load_state(mirror_path(region, data_schema.__tablename__))['entities']
+    if entity_ids is None:
+        entity_ids = list(mirrored.keys())
+
+    covered = [mirrored[entity_id] for entity_id in entity_ids if entity_id in mirrored]
+    missing = [entity_id for entity_id in entity_ids if entity_id not in mirrored]
+    return (min(covered) if covered else None), missing
+
+
+def read_mirror(region: Region,
+                data_schema: DeclarativeMeta,
+                entity_ids=None,
+                columns=None,
+                start_timestamp=None,
+                end_timestamp=None) -> pd.DataFrame:
+    """
+    read the mirrored rows of data_schema, the year and bucket partitions, and the row groups
+    outside the entity and time range are skipped, only columns are decoded
+    """
+    import pyarrow.dataset as ds
+
+    path = mirror_path(region, data_schema.__tablename__)
+    if not os.path.exists(path):
+        return pd.DataFrame()
+
+    state = load_state(path)
+    # _state.json is skipped by the default ignore_prefixes
+    dataset = ds.dataset(path, format='parquet', partitioning=mirror_partitioning())
+
+    expression = None
+
+    def both(left, right):
+        return right if left is None else left & right
+
+    if entity_ids is not None:
+        buckets = list(set(entity_bucket(entity_id, state['buckets']) for entity_id in entity_ids))
+        expression = both(expression, ds.field('bucket').isin(buckets))
+        expression = both(expression, ds.field('entity_id').isin(list(entity_ids)))
+    if start_timestamp:
+        start_timestamp = to_pd_timestamp(start_timestamp)
+        expression = both(expression, ds.field('year') >= start_timestamp.year)
+        expression = both(expression, ds.field('timestamp') >= start_timestamp)
+    if end_timestamp:
+        end_timestamp = to_pd_timestamp(end_timestamp)
+        expression = both(expression, ds.field('year') <= end_timestamp.year)
+        expression = both(expression, ds.field('timestamp') <= end_timestamp)
+
+    if columns:
+        columns = list(dict.fromkeys([col if isinstance(col, str) else col.key for col in columns] +
+                                     ['id', 'entity_id', 'timestamp']))
+    else:
+        columns = [col.key for col in data_schema.__table__.columns]
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
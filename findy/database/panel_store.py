@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from findy import findy_config, findy_env
+from findy.interface import Region
+from findy.database.context import get_db_session
+from findy.database.watermark import get_latest_timestamps
+from findy.utils.time import PRECISION_STR, to_pd_timestamp
+
+logger = logging.getLogger(__name__)
+
+# fields kept in the panel, one memory mapped float64 array of (entity x trading day) each
+panel_fields = ['open', 'high', 'low', 'close', 'volume']
+
+# (region, name) -> opened PanelStore, reopened when the store is rewritten
+__panel_stores = {}
+
+
+def panel_path(region: Region, name: str) -> str:
+    return os.path.join(findy_env['panel_path'], region.value, name)
+
+
+def to_days(timestamps) -> np.ndarray:
+    return pd.DatetimeIndex(timestamps).values.astype('datetime64[D]').astype(np.int64)
+
+
+def grow(size: int, capacity: int) -> int:
+    while capacity < size:
+        capacity = max(capacity * 2, 64)
+    return capacity
+
+
+class PanelStore(object):
+    """
+    on disk (entity x trading day) panel of the daily kdata fields
+
+    meta.json holds the entity index (entity_id, code, table of every row), the calendar
+    (days since epoch of every column) and the allocated capacity, field values are
+    memory mapped from {field}.{generation}.f64, NaN where the entity has no record
+    """
+
+    def __init__(self, region: Region, name: str) -> None:
+        self.region = region
+        self.name = name
+        self.path = panel_path(region, name)
+
+        self.meta = None
+        self.mtime = None
+        self.arrays = {}
+        self.rows = {}
+        # generations replaced by reallocate, removed on flush
+        self.retired = []
+
+    @property
+    def entity_ids(self):
+        return self.meta['entity_ids']
+
+    @property
+    def codes(self):
+        return self.meta['codes']
+
+    @property
+    def calendar(self) -> np.ndarray:
+        return self.meta['calendar']
+
+    def field_path(self, field: str, generation: int) -> str:
+        return os.path.join(self.path, f'{field}.{generation}.f64')
+
+    def load(self, mode='r') -> bool:
+        meta_path = os.path.join(self.path, 'meta.json')
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        meta['calendar'] = np.array(meta['calendar'], dtype=np.int64)
+        shape = (meta['entity_capacity'], meta['day_capacity'])
+
+        try:
+            arrays = {field: np.memmap(self.field_path(field, meta['generation']), dtype=np.float64,
+                                       mode=mode, shape=shape)
+                      for field in panel_fields}
+        except FileNotFoundError:
+            # replaced by a writer since meta was read
+            return False
+
+        self.meta = meta
+        self.mtime = mtime
+        self.arrays = arrays
+        self.rows = {entity_id: row for row, entity_id in enumerate(meta['entity_ids'])}
+        return True
+
+    def is_stale(self) -> bool:
+        try:
+            return os.stat(os.path.join(self.path, 'meta.json')).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return True
+
+    def field(self, field: str) -> np.ndarray:
+        """
+        the (entity x day) values of field, a view on the mapped file
+        """
+        return self.arrays[field][:len(self.entity_ids), :len(self.calendar)]
+
+    def day_slice(self, start_timestamp=None, end_timestamp=None) -> slice:
+        calendar = self.calendar
+        start = np.searchsorted(calendar, to_days([to_pd_timestamp(start_timestamp)])[0]) if start_timestamp else 0
+        end = np.searchsorted(calendar, to_days([to_pd_timestamp(end_timestamp)])[0], side='right') \
+            if end_timestamp else len(calendar)
+        return slice(start, end)
+
+    def code_rows(self, codes=None) -> np.ndarray:
+        if codes is None:
+            return np.arange(len(self.entity_ids))
+        codes = set(codes)
+        return np.array([row for row, code in enumerate(self.codes) if code in codes], dtype=np.int64)
+
+    def slice(self, field: str, codes=None, start_timestamp=None, end_timestamp=None) -> np.ndarray:
+        """
+        values of field for the entities of codes in [start_timestamp, end_timestamp],
+        a zero copy view if codes is None, the selected rows are copied otherwise
+        """
+        values = self.field(field)[:, self.day_slice(start_timestamp, end_timestamp)]
+        if codes is None:
+            return values
+        return values[self.code_rows(codes)]
+
+    def panel(self, codes=None, start_timestamp=None, end_timestamp=None):
+        """
+        the entities of codes in [start_timestamp, end_timestamp] as an in memory Panel
+        """
+        from findy.interface.panel import Panel
+
+        rows = self.code_rows(codes)
+        days = self.day_slice(start_timestamp, end_timestamp)
+        values = np.stack([self.field(field)[rows, days] for field in panel_fields])
+        timestamps = self.calendar[days].astype('datetime64[D]').astype('datetime64[ns]')
+        return Panel(values, panel_fields, [self.entity_ids[row] for row in rows], timestamps)
+
+    def save_meta(self):
+        meta = dict(self.meta)
+        meta['calendar'] = self.meta['calendar'].tolist()
+
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def reallocate(self, entity_capacity: int, day_capacity: int, columns: np.ndarray = None):
+        """
+        copy the fields into files of a new generation, the current days are moved to columns if set,
+        readers keep the old mapping until they reload, returns the replaced generation
+        """
+        generation = self.meta['generation'] + 1
+        entities = len(self.entity_ids)
+        days = len(self.calendar)
+
+        arrays = {}
+        for field in panel_fields:
+            array = np.memmap(self.field_path(field, generation), dtype=np.float64, mode='w+',
+                              shape=(entity_capacity, day_capacity))
+            array[:] = np.nan
+            if entities and days:
+                array[:entities, columns if columns is not None else slice(0, days)] = \
+                    self.arrays[field][:entities, :days]
+            arrays[field] = array
+
+        old = self.meta['generation']
+        self.arrays = arrays
+        self.meta.update(generation=generation, entity_capacity=entity_capacity, day_capacity=day_capacity)
+
+        return old
+
+    def reset(self):
+        """
+        empty the store into a new generation
+        """
+        if self.meta is not None:
+            self.retired.append(self.meta['generation'])
+        generation = self.meta['generation'] if self.meta is not None else -1
+
+        self.meta = {'entity_ids': [], 'codes': [], 'tables': [], 'calendar': np.array([], dtype=np.int64),
+                     'generation': generation, 'entity_capacity': 0, 'day_capacity': 0}
+        self.rows = {}
+        self.reallocate(entity_capacity=64, day_capacity=64)
+
+    def write(self, df: pd.DataFrame, tablename: str):
+        """
+        write the rows of df into the panel, new entities and new trading days are added
+        """
+        entities = df[['entity_id', 'code']].drop_duplicates('entity_id')
+        entities = entities[~entities['entity_id'].isin(self.rows)]
+
+        days = to_days(df['timestamp'])
+        calendar = self.calendar
+        merged = np.union1d(calendar, days)
+
+        entity_capacity = grow(len(self.entity_ids) + len(entities), self.meta['entity_capacity'])
+        day_capacity = grow(len(merged), self.meta['day_capacity'])
+
+        if len(calendar) > 0 and merged[len(calendar) - 1] != calendar[-1]:
+            # trading days inserted into the history, move the current days to their new columns
+            self.retired.append(self.reallocate(entity_capacity, day_capacity,
+                                                columns=np.searchsorted(merged, calendar)))
+        elif entity_capacity != self.meta['entity_capacity'] or day_capacity != self.meta['day_capacity']:
+            self.retired.append(self.reallocate(entity_capacity, day_capacity))
+        self.meta['calendar'] = merged
+
+        for entity_id, code in entities.itertuples(index=False):
+            self.rows[entity_id] = len(self.meta['entity_ids'])
+            self.meta['entity_ids'].append(entity_id)
+            self.meta['codes'].append(code)
+            self.meta['tables'].append(tablename)
+
+        rows = df['entity_id'].map(self.rows).values
+        cols = np.searchsorted(merged, days)
+        for field in panel_fields:
+            self.arrays[field][rows, cols] = df[field].values.astype(np.float64)
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.save_meta()
+
+        # the replaced files are removed once the new meta is published
+        for generation in self.retired:
+            if generation == self.meta['generation']:
+                continue
+            for field in panel_fields:
+                try:
+                    os.remove(self.field_path(field, generation))
+                except FileNotFoundError:
+                    pass
+        self.retired = []
+
+
+def load_rows(region: Region, data_schema, entity_ids=None, start_timestamp=None) -> pd.DataFrame:
+    provider = data_schema.providers[region][0]
+    db_session = get_db_session(region, provider, data_schema)
+    df, _ = data_schema.query_data(region=region,
+                                   provider=provider,
+                                   db_session=db_session,
+                                   entity_ids=entity_ids,
+                                   columns=['entity_id', 'code', 'timestamp'] + panel_fields,
+                                   start_timestamp=start_timestamp,
+                                   return_type='df')
+    return df
+
+
+def update_panel_store(region: Region, name: str, data_schemas: list, rebuild: bool = False):
+    """
+    bring the panel store up to date with the daily kdata of data_schemas
+
+    the last trading day of the store is reloaded as it may have been recorded intraday,
+    entities new to the store are loaded with their whole history
+    """
+    now = time.time()
+    path = panel_path(region, name)
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        store = PanelStore(region, name)
+        if not store.load(mode='r+') or rebuild:
+            store.reset()
+
+        batch = findy_config.get('mirror_batch_entities', 500)
+        written = 0
+        for data_schema in data_schemas:
+            tablename = data_schema.__tablename__
+            db_session = get_db_session(region, data_schema.providers[region][0], data_schema)
+
+            known = set(entity_id for entity_id, table in zip(store.entity_ids, store.meta['tables'])
+                        if table == tablename)
+            new = sorted(set(get_latest_timestamps(db_session, tablename).keys()) - known)
+
+            dfs = []
+            if known and len(store.calendar) > 0:
+                last_day = pd.Timestamp(np.datetime64(int(store.calendar[-1]), 'D'))
+                dfs.append(load_rows(region, data_schema, start_timestamp=last_day))
+            dfs += [load_rows(region, data_schema, entity_ids=new[i:i + batch]) for i in range(0, len(new), batch)]
+
+            for df in dfs:
+                if df is None or len(df) == 0:
+                    continue
+                df = df[df['timestamp'].notna()]
+                store.write(df, tablename)
+                written += len(df)
+
+        store.flush()
+
+    cost = PRECISION_STR.format(time.time() - now)
+    logger.info(f'update panel store: [ {name} ], entities: {len(store.entity_ids)}, '
+                f'days: {len(store.calendar)}, rows: {written}, cost: {cost}')
+    return written
+
+
+def get_panel_store(region: Region, name: str):
+    """
+    the opened panel store, None if it is not built yet
+    """
+    key = (region, name)
+    store = __panel_stores.get(key)
+    if store is not None and not store.is_stale():
+        return store
+
+    # a writer may replace the files between reading meta and mapping them
+    for _ in range(3):
+        store = PanelStore(region, name)
+        if store.load():
+            __panel_stores[key] = store
+            return store
+        if not os.path.exists(os.path.join(panel_path(region, name), 'meta.json')):
+            break
+    return None
+
+
+def update_panel_stores(region: Region, tablename: str = None) -> int:
+    """
+    update the panel stores of region configured in panel_stores, only those built from tablename if set
+    """
+    from findy.database.schema.register import get_schemas
+
+    schemas = {}
+    for data_schema in get_schemas(region):
+        schemas.setdefault(data_schema.__tablename__, data_schema)
+
+    written = 0
+    for name, tablenames in findy_config.get('panel_stores', {}).get(region.value, {}).items():
+        if tablename is not None and tablename not in tablenames:
+            continue
+        try:
+            written += update_panel_store(region, name, [schemas[t] for t in tablenames if t in schemas])
+        except Exception as e:
+            logger.error(f'update panel store: [ {name} ] failed, {e}')
+    return written
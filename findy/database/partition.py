@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import time
+
+import pandas as pd
+from sqlalchemy import text
+
+from findy import findy_config, findy_env
+from findy.utils.time import PRECISION_STR
+
+logger = logging.getLogger(__name__)
+
+# partition interval -> (pandas period freq, partition name suffix format)
+intervals = {
+    'month': ('M', '%Y%m'),
+    'year': ('Y', '%Y'),
+}
+
+# (engine url, tablename) -> (stamp, names of the known partitions, None if the table is not partitioned)
+__table_partitions = {}
+
+
+def partition_interval(tablename: str):
+    """
+    the partition interval configured for a kdata table, None for a plain table
+
+    kdata_partitions maps the level to the interval, e.g. {"1m": "month", "15m": "year"},
+    stock_1m_kdata, stock_1m_hfq_kdata and stock_1m_bfq_kdata share the 1m interval
+    """
+    parts = tablename.split('_')
+    if len(parts) < 3 or parts[-1] != 'kdata':
+        return None
+
+    interval = findy_config.get('kdata_partitions', {}).get(parts[1])
+    if interval is not None and interval not in intervals:
+        logger.warning(f'unknown partition interval: {interval} of table: [ {tablename} ]')
+        return None
+    return interval
+
+
+def declares_partitions(table) -> bool:
+    """
+    whether the ORM table is declared partitioned, by kdata_partitions at import time
+    """
+    return table.kwargs.get('postgresql_partition_by') is not None
+
+
+def is_partitioned(engine, tablename: str) -> bool:
+    """
+    whether tablename is a partitioned table in the database, whatever the ORM declares
+    """
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "select 1 from pg_partitioned_table where partrelid = to_regclass(:t)"), {'t': tablename}).scalar() is not None
+
+
+def partition_ranges(interval: str, start, end):
+    """
+    yield (partition name suffix, lower bound, upper bound) of the partitions covering [start, end]
+    """
+    freq, fmt = intervals[interval]
+    for period in pd.period_range(pd.Timestamp(start), pd.Timestamp(end), freq=freq):
+        yield period.start_time.strftime(fmt), period.start_time, (period + 1).start_time
+
+
+def partition_bounds(interval: str, tablename: str, name: str):
+    """
+    (lower bound, upper bound) of the partition name created by ensure_partitions, None if not parsable
+    """
+    freq, fmt = intervals[interval]
+    try:
+        start = pd.Timestamp(pd.to_datetime(name[len(f'{tablename}_p'):], format=fmt))
+    except ValueError:
+        return None
+    period = start.to_period(freq)
+    return period.start_time, (period + 1).start_time
+
+
+def get_partitions(engine, tablename: str):
+    """
+    names of the partitions attached to tablename, None if it is not a partitioned table
+    """
+    with engine.connect() as connection:
+        partitioned = connection.execute(text(
+            "select 1 from pg_partitioned_table where partrelid = to_regclass(:t)"), {'t': tablename}).scalar()
+        if not partitioned:
+            return None
+
+        rows = connection.execute(text(
+            "select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid "
+            "where i.inhparent = to_regclass(:t)"), {'t': tablename}).fetchall()
+        return set(row[0] for row in rows)
+
+
+def stamp_path(engine, tablename: str) -> str:
+    return os.path.join(findy_env['cache_path'], 'partition_stamp', f'{engine.url.database}_{tablename}')
+
+
+def partitions_stamp(engine, tablename: str) -> int:
+    """
+    the mtime of the stamp file of tablename, moved by forget_partitions,
+    so partitions dropped by one process are reloaded by every process
+    """
+    try:
+        return os.stat(stamp_path(engine, tablename)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def forget_partitions(engine, tablename: str):
+    """
+    drop the cached partition names of tablename, after partitions are detached or dropped
+    """
+    __table_partitions.pop((str(engine.url), tablename), None)
+
+    path = stamp_path(engine, tablename)
+    now = time.time_ns()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a'):
+            pass
+        # mtime must move forward even if the clock tick is coarse
+        previous = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(now, max(now, previous + 1)))
+    except OSError as e:
+        logger.warning(f'stamp partitions of table: [ {tablename} ] failed, {e}')
+
+
+def ensure_partitions(engine, table, start, end) -> int:
+    """
+    create the missing partitions of table covering [start, end]
+
+    partitions are created in their own autocommit connection, so the DDL lock
+    on the parent table is not held by the COPY transaction, returns created counts
+    """
+    interval = partition_interval(table.name)
+    if interval is None or pd.isna(start) or pd.isna(end):
+        return 0
+
+    key = (str(engine.url), table.name)
+    stamp = partitions_stamp(engine, table.name)
+    if key not in __table_partitions or __table_partitions[key][0] != stamp:
+        __table_partitions[key] = (stamp, get_partitions(engine, table.name))
+        if __table_partitions[key][1] is None:
+            logger.warning(f'table: [ {table.name} ] was created before the partitioned layout was configured, '
+                           f'it is kept plain until migrated by partition_table')
+
+    known = __table_partitions[key][1]
+    if known is None:
+        return 0
+
+    missing = [(f'{table.name}_p{suffix}', lower, upper)
+               for suffix, lower, upper in partition_ranges(interval, start, end)
+               if f'{table.name}_p{suffix}' not in known]
+    if not missing:
+        return 0
+
+    created = 0
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for name, lower, upper in missing:
+            try:
+                connection.execute(text(
+                    f"create table if not exists {name} partition of {table.name} "
+                    f"for values from ('{lower}') to ('{upper}')"))
+                known.add(name)
+                created += 1
+                logger.info(f'create partition: [ {name} ], range: [ {lower}, {upper} )')
+            except Exception as e:
+                # another worker may have created it concurrently, it is checked again on the next call
+                logger.warning(f'create partition: [ {name} ] failed, {e}')
+
+    return created
+
+
+def partition_table(engine, table) -> bool:
+    """
+    migrate the plain table created before kdata_partitions was configured to the partitioned layout
+
+    the rows are copied into the partitioned table declared by the ORM in one transaction holding
+    an ACCESS EXCLUSIVE lock on the table, so recorders writing to it must be stopped,
+    the secondary indexes are recreated on it, returns whether the table was migrated
+    """
+    interval = partition_interval(table.name)
+    if interval is None or not declares_partitions(table):
+        logger.warning(f'table: [ {table.name} ] is not configured in kdata_partitions')
+        return False
+
+    if get_partitions(engine, table.name) is not None:
+        return False
+
+    plain = f'{table.name}_plain'
+
+    now = time.time()
+    with engine.begin() as connection:
+        if connection.execute(text("select to_regclass(:t)"), {'t': table.name}).scalar() is None:
+            return False
+
+        connection.execute(text(f"lock table {table.name} in access exclusive mode"))
+
+        pkey = connection.execute(text(
+            "select conname from pg_constraint where conrelid = to_regclass(:t) and contype = 'p'"),
+            {'t': table.name}).scalar()
+        indexes = connection.execute(text(
+            "select indexname, indexdef from pg_indexes where schemaname = current_schema() and tablename = :t"),
+            {'t': table.name}).fetchall()
+
+        connection.execute(text(f"alter table {table.name} rename to {plain}"))
+        if pkey is not None:
+            connection.execute(text(f"alter table {plain} rename constraint {pkey} to {plain}_pkey"))
+
+        table.create(connection)
+
+        lower, upper = connection.execute(text(f"select min(timestamp), max(timestamp) from {plain}")).first()
+        if lower is not None:
+            for suffix, start, end in partition_ranges(interval, lower, upper):
+                connection.execute(text(
+                    f"create table {table.name}_p{suffix} partition of {table.name} "
+                    f"for values from ('{start}') to ('{end}')"))
+
+        # columns added to the ORM after the table was created are not in it
+        existing = set(row[0] for row in connection.execute(text(
+            "select attname from pg_attribute where attrelid = to_regclass(:t) and attnum > 0 and not attisdropped"),
+            {'t': plain}).fetchall())
+        columns = ', '.join(f'"{col.name}"' for col in table.columns if col.name in existing)
+        rows = connection.execute(text(f"insert into {table.name} ({columns}) select {columns} from {plain}")).rowcount
+        connection.execute(text(f"drop table {plain}"))
+
+        for index_name, definition in indexes:
+            if index_name != pkey:
+                connection.execute(text(definition))
+
+    forget_partitions(engine, table.name)
+
+    cost = PRECISION_STR.format(time.time() - now)
+    logger.info(f'partition table: [ {table.name} ], rows: {rows}, cost: {cost}')
+    return True
+
+
+def migrate_partitions(region) -> int:
+    """
+    migrate the plain tables of region configured in kdata_partitions, returns the migrated table counts
+    """
+    from findy.database.context import get_db_engine
+    from findy.database.schema.register import get_schemas
+
+    engine = get_db_engine(region)
+
+    migrated = 0
+    tablenames = set()
+    for data_schema in get_schemas(region):
+        table = data_schema.__table__
+        # schemas are registered once per provider
+        if table.name in tablenames or partition_interval(table.name) is None:
+            continue
+        tablenames.add(table.name)
+
+        try:
+            migrated += partition_table(engine, table)
+        except Exception as e:
+            logger.error(f'partition table: [ {table.name} ] failed, {e}')
+
+    return migrated
@@ -1,21 +1,84 @@
 import logging
 import os
 import time
-from io import StringIO
+from io import StringIO, BytesIO
 
 import pandas as pd
-from sqlalchemy.dialects import postgresql
+import psycopg2
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
-from findy import findy_env
+from findy import findy_config, findy_env
 from findy.interface import Region, Provider
 from findy.database.schema.register import get_schema_columns
 from findy.database.context import get_db_engine
+from findy.database.schema.misc.quarantine import QuarantineBase, CopyQuarantine
+from findy.database.partition import ensure_partitions
+from findy.database.statement import select_statement
+from findy.database.query_cache import bump_generation
+from findy.database.watermark import (has_watermark, ensure_watermark_table, update_watermarks,
+                                     returning_watermarks_sql, discount_watermarks)
+from findy.database.pgcopy import (support_binary, to_pgcopy, iter_csv_chunks, iter_pgcopy_chunks, CopyStream,
+                                   copy_csv_types)
 from findy.utils.pd import pd_valid
 from findy.utils.time import PRECISION_STR
 
 logger = logging.getLogger(__name__)
 
+# max ids bound into one "id in (...)" lookup
+id_chunk_size = 5000
+
+# regions with the quarantine table created
+__quarantine_regions = set()
+
+# SQLSTATE of a row already saved, and the classes of the errors caused by the values of a row
+unique_violation = '23505'
+row_error_classes = ('22', '23')
+
+
+def get_saved_ids(region: Region,
+                  provider: Provider,
+                  data_schema: DeclarativeMeta,
+                  db_session,
+                  df: pd.DataFrame,
+                  ref_entity=None,
+                  dedup_mode: str = 'ids') -> set:
+    """
+    load the ids already saved in db which may collide with df
+
+    :param dedup_mode: 'full', all saved ids of ref_entity (or the whole table if ref_entity is None)
+                       'window', saved ids inside [min(timestamp), max(timestamp)] of df
+                       'ids', only the saved ids of df
+    """
+    if dedup_mode == 'window' and ('timestamp' not in df.columns or df['timestamp'].isnull().any()):
+        dedup_mode = 'ids'
+
+    entity_id = ref_entity.id if ref_entity is not None else None
+
+    by = 'entity_id' if entity_id is not None else None
+
+    if dedup_mode == 'ids':
+        ids = df['id'].tolist()
+        statement = select_statement(data_schema, ('id',), by='ids')
+        params = [dict(ids=ids[i:i + id_chunk_size]) for i in range(0, len(ids), id_chunk_size)]
+    elif dedup_mode == 'window':
+        statement = select_statement(data_schema, ('id',), by=by, start=True, end=True)
+        params = [dict(entity_id=entity_id,
+                       start_timestamp=pd.Timestamp(df['timestamp'].min()),
+                       end_timestamp=pd.Timestamp(df['timestamp'].max()))]
+    else:
+        statement = select_statement(data_schema, ('id',), by=by)
+        params = [dict(entity_id=entity_id)]
+
+    saved_ids = set()
+    for param in params:
+        try:
+            saved_ids.update(db_session.execute(statement, param).scalars())
+        except Exception as e:
+            logger.error(f"query {data_schema.__tablename__} failed with error: {e}")
+            db_session.rollback()
+
+    return saved_ids
+
 
 async def df_to_db(region: Region,
                    provider: Provider,
@@ -25,7 +88,16 @@ async def df_to_db(region: Region,
                    ref_entity = None,
                    drop_duplicates: bool = True,
                    fix_duplicate_way: str = 'ignore',
-                   force_update=False) -> object:
+                   force_update=False,
+                   dedup_mode: str = 'ids',
+                   write_mode: str = 'copy',
+                   copy_format: str = 'csv') -> object:
+    """
+    :param write_mode: 'copy', dedup on client side and COPY the new rows
+                       'upsert', COPY into a staging table and let the server resolve conflicts,
+                       existing rows are kept, or updated if force_update
+    :param copy_format: 'csv' or 'binary', binary COPY is encoded straight from the numpy columns
+    """
     now = time.time()
 
     if not pd_valid(df):
@@ -43,6 +115,13 @@ async def df_to_db(region: Region,
 
     df = df[cols]
 
+    if write_mode == 'upsert':
+        saved = upsert_postgresql(region, df, data_schema, update=force_update, copy_format=copy_format)
+
+        cost = PRECISION_STR.format(time.time() - now)
+        logger.debug(f"upsert db: {cost}, size: {saved}")
+        return saved
+
     # force update mode, delete duplicate id data, and rewrite new data back
     if force_update:
         ids = df["id"].tolist()
@@ -51,13 +130,21 @@ async def df_to_db(region: Region,
         else:
             sql = f"delete from {data_schema.__tablename__} where id in {tuple(ids)}"
 
+        watermarked = has_watermark(data_schema.__table__.columns.keys())
+        if watermarked:
+            ensure_watermark_table(region)
+            sql += " returning entity_id"
+
         try:
-            db_session.execute(sql)
+            result = db_session.execute(sql)
+            if watermarked:
+                discount_watermarks(db_session, data_schema.__tablename__, [row[0] for row in result])
         except Exception as e:
             logger.error(f"query {data_schema.__tablename__} failed with error: {e}")
 
         try:
             db_session.commit()
+            bump_generation(region, data_schema.__tablename__)
         except Exception as e:
             logger.error(f'df_to_db {data_schema.__tablename__}, error: {e}')
             db_session.rollback()
@@ -66,28 +153,10 @@ async def df_to_db(region: Region,
         df_new = df
 
     else:
-        ref_df = None
-        if ref_entity is not None:
-            data, column_names = data_schema.query_data(
-                region=region,
-                provider=provider,
-                db_session=db_session,
-                entity_id=ref_entity.id,
-                columns=[data_schema.id, data_schema.timestamp])
-                # order=data_schema.desc(),
-                # limit=1000)
-        else:
-            data, column_names = data_schema.query_data(
-                region=region,
-                provider=provider,
-                db_session=db_session,
-                columns=[data_schema.id, data_schema.timestamp])
-            
-        if data and len(data) > 0:
-            ref_df = pd.DataFrame(data, columns=column_names)
-
-        if pd_valid(ref_df):
-            df_new = df[~df.id.isin(ref_df.id)]
+        ref_ids = get_saved_ids(region, provider, data_schema, db_session, df, ref_entity, dedup_mode)
+
+        if ref_ids:
+            df_new = df[~df.id.isin(ref_ids)]
         else:
             df_new = df
 
@@ -104,7 +173,8 @@ async def df_to_db(region: Region,
 
     saved = 0
     if pd_valid(df_new):
-        saved = to_postgresql(region, df_new, data_schema.__tablename__)
+        saved = to_postgresql(region, df_new, data_schema.__tablename__,
+                              copy_format=copy_format, data_schema=data_schema)
 
     cost = PRECISION_STR.format(time.time() - rmdup)
     logger.debug(f"write db: {cost}, size: {saved}")
@@ -112,65 +182,259 @@ async def df_to_db(region: Region,
     return saved
 
 
-def to_postgresql(region: Region, df, tablename):
-    # now = time.time()
+def copy_df(cursor, df, tablename, copy_format='csv', data_schema=None, chunk_rows=None):
+    """
+    COPY df into tablename, frames larger than chunk_rows are encoded and streamed
+    chunk by chunk, so the encoded text never holds the whole frame
+    """
+    if chunk_rows is None:
+        chunk_rows = findy_config.get('copy_chunk_rows', 100000)
+
+    streaming = 0 < chunk_rows < len(df)
+
+    if copy_format == 'binary' and data_schema is not None:
+        if support_binary(data_schema.__table__, df.columns):
+            cols = ', '.join(f'"{col}"' for col in df.columns)
+            sql = f'copy {tablename} ({cols}) from stdin with (format binary)'
+            if streaming:
+                with CopyStream(iter_pgcopy_chunks(df, data_schema.__table__, chunk_rows)) as output:
+                    cursor.copy_expert(sql, output, size=1024 * 64)
+            else:
+                cursor.copy_expert(sql, BytesIO(to_pgcopy(df, data_schema.__table__)), size=1024 * 64)
+            return
+        logger.debug(f'binary copy not supported on table: [ {tablename} ], fallback to csv')
+
+    if streaming:
+        with CopyStream(iter_csv_chunks(df, chunk_rows)) as output:
+            cursor.copy_from(output, tablename, null='', size=1024 * 16, columns=list(df.columns))
+        return
 
-    saved = len(df)
     output = StringIO()
     df.to_csv(output, sep='\t', index=False, header=False, encoding='utf-8')
     output.seek(0)
 
-    # to_csv_time = time.time()
-    # cost = PRECISION_STR.format(to_csv_time - now)
-    # logger.debug(f"dataFrame to IO: {cost}, size: {saved}")
+    cursor.copy_from(output, tablename, null='', size=1024 * 16, columns=list(df.columns))
+
+
+def is_row_error(error) -> bool:
+    """
+    whether the COPY error is caused by the values of the rows, data exceptions (class 22)
+    and constraint violations (class 23), or encoding them on the client
+    """
+    if not isinstance(error, psycopg2.Error):
+        return True
+    return error.pgcode is not None and error.pgcode[:2] in row_error_classes
+
+
+def copy_skip_saved(cursor, df, tablename, bad_rows: list, max_bad_rows: int, **kwargs) -> int:
+    """
+    COPY df through a staging table, then insert it skipping the rows already saved,
+    e.g. written by another worker since the dedup, returns the inserted counts
+    """
+    staging = f'{tablename}_saved_staging'
+    cursor.execute(f'create temp table if not exists {staging} (like {tablename} including defaults) on commit drop')
+    cursor.execute(f'truncate {staging}')
+    bisect_copy(cursor, df, staging, bad_rows, max_bad_rows, **kwargs)
+
+    cols = ', '.join(f'"{col}"' for col in df.columns)
+    cursor.execute(f'insert into {tablename} ({cols}) select {cols} from {staging} on conflict do nothing')
+    return cursor.rowcount
+
+
+def bisect_copy(cursor, df, tablename, bad_rows: list, max_bad_rows: int, **kwargs) -> int:
+    """
+    COPY df under a savepoint, on failure split it in halves until the offending
+    rows are isolated, so one malformed row does not reject the whole batch
+
+    a unique violation is not a malformed row, the batch is inserted skipping the saved rows instead,
+    the rejected rows are collected as (row, error) into bad_rows,
+    raise the COPY error once more than max_bad_rows are rejected, or if it is not caused by the rows
+    """
+    cursor.execute('savepoint bisect_copy')
+    try:
+        copy_df(cursor, df, tablename, **kwargs)
+    except Exception as e:
+        cursor.execute('rollback to savepoint bisect_copy')
+        if getattr(e, 'pgcode', None) == unique_violation:
+            return copy_skip_saved(cursor, df, tablename, bad_rows, max_bad_rows, **kwargs)
+        if not is_row_error(e):
+            raise
+
+        if len(df) == 1:
+            bad_rows.append((df, str(e).strip()))
+            if len(bad_rows) > max_bad_rows:
+                raise
+            return 0
+
+        mid = len(df) // 2
+        return bisect_copy(cursor, df.iloc[:mid], tablename, bad_rows, max_bad_rows, **kwargs) + \
+            bisect_copy(cursor, df.iloc[mid:], tablename, bad_rows, max_bad_rows, **kwargs)
+
+    cursor.execute('release savepoint bisect_copy')
+    return len(df)
+
+
+def quarantine_rows(region: Region, cursor, tablename, bad_rows: list):
+    """
+    insert the rejected rows into the quarantine table, in the transaction of cursor
+    """
+    if region not in __quarantine_regions:
+        QuarantineBase.metadata.create_all(get_db_engine(region), checkfirst=True)
+        __quarantine_regions.add(region)
+
+    now = pd.Timestamp.now()
+    values = [(tablename,
+               str(row['id'].iloc[0]) if 'id' in row.columns and pd.notna(row['id'].iloc[0]) else None,
+               row.to_json(orient='records', date_format='iso', default_handler=str)[1:-1],
+               error,
+               now) for row, error in bad_rows]
 
+    cursor.executemany(f'insert into {CopyQuarantine.__tablename__} (table_name, row_id, row, error, timestamp) '
+                       'values (%s, %s, %s, %s, %s)', values)
+
+    for row, error in bad_rows:
+        logger.warning(f'quarantine row on table: [ {tablename} ], {error}')
+
+
+def saved_rows(df, bad_rows: list):
+    if not bad_rows or 'id' not in df.columns:
+        return df
+    bad_ids = pd.concat([row['id'] for row, _ in bad_rows])
+    return df[~df['id'].isin(bad_ids)]
+
+
+def prepare_partitions(db_engine, df, data_schema):
+    if data_schema is not None and 'timestamp' in df.columns and len(df) > 0:
+        timestamps = pd.to_datetime(df['timestamp'])
+        ensure_partitions(db_engine, data_schema.__table__, timestamps.min(), timestamps.max())
+
+
+def to_postgresql(region: Region, df, tablename, copy_format='csv', data_schema=None, chunk_rows=None,
+                  bad_rows: list = None):
+    """
+    COPY df into tablename, returns the saved counts, the rejected rows are quarantined
+    and collected as (row, error) into bad_rows if given
+    """
     db_engine = get_db_engine(region)
+    prepare_partitions(db_engine, df, data_schema)
+
     connection = db_engine.raw_connection()
     cursor = connection.cursor()
-    
+
+    if bad_rows is None:
+        bad_rows = []
     try:
-        cursor.copy_from(output, tablename, null='', size=1024 * 16, columns=list(df.columns))
+        saved = bisect_copy(cursor, df, tablename, bad_rows, findy_config.get('copy_max_bad_rows', 100),
+                            copy_format=copy_format, data_schema=data_schema, chunk_rows=chunk_rows)
+        if bad_rows:
+            quarantine_rows(region, cursor, tablename, bad_rows)
+        update_watermarks(region, cursor, tablename, saved_rows(df, bad_rows))
     except Exception as e:
         logger.error(f'copy_from failed on table: [ {tablename} ], {e}')
+        connection.rollback()
         err_msg = str(e).replace("\"", "")
         df.to_csv(os.path.join(findy_env['err_path'], f'{err_msg[:min(len(err_msg), 50)]}.csv'))
         cursor.close()
         connection.close()
         return 0
-    
+
     try:
         connection.commit()
+        bump_generation(region, tablename)
     except Exception as e:
         logger.error(f'copy_from commit failed on table: [ {tablename} ], {e}')
         connection.rollback()
+        saved = 0
     finally:
         cursor.close()
         connection.close()
-    
-    # to_db_time = time.time()
-    # cost = PRECISION_STR.format(to_db_time - to_csv_time)
-    # logger.debug(f"write to db: {cost}, size: {saved}")
 
     return saved
 
 
-def from_postgresql(region: Region, query):
-    statement = query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
-    copy_sql = "COPY ({query}) TO STDOUT WITH CSV {head}".format(query=statement, head="HEADER")
+def upsert_postgresql(region: Region, df, data_schema, update: bool = False, copy_format='csv'):
+    table = data_schema.__table__
+    tablename = table.name
+    staging = f'{tablename}_staging'
+
+    cols = ', '.join(f'"{col}"' for col in df.columns)
+    keys = [col.name for col in table.primary_key]
+    updates = ', '.join(f'"{col}" = excluded."{col}"' for col in df.columns if col not in keys)
+
+    if update and updates:
+        conflict = f'do update set {updates}'
+    else:
+        conflict = 'do nothing'
+
+    keys = ', '.join(f'"{key}"' for key in keys)
 
     db_engine = get_db_engine(region)
+    prepare_partitions(db_engine, df, data_schema)
+
+    if has_watermark(table.columns.keys()):
+        ensure_watermark_table(region)
+
     connection = db_engine.raw_connection()
     cursor = connection.cursor()
 
+    # staging table lives in the session only, never WAL-logged, and is dropped on commit
     try:
+        cursor.execute(f'create temp table if not exists {staging} (like {tablename} including defaults) on commit drop')
+        bad_rows = []
+        bisect_copy(cursor, df, staging, bad_rows, findy_config.get('copy_max_bad_rows', 100),
+                    copy_format=copy_format, data_schema=data_schema)
+        insert_sql = f'insert into {tablename} ({cols}) select {cols} from {staging} on conflict ({keys}) {conflict}'
+        if has_watermark(table.columns.keys()):
+            cursor.execute(returning_watermarks_sql(tablename, insert_sql))
+            saved = cursor.fetchone()[0]
+        else:
+            cursor.execute(insert_sql)
+            saved = cursor.rowcount
+        if bad_rows:
+            quarantine_rows(region, cursor, tablename, bad_rows)
+        connection.commit()
+        bump_generation(region, tablename)
+    except Exception as e:
+        logger.error(f'upsert failed on table: [ {tablename} ], {e}')
+        connection.rollback()
+        saved = 0
+    finally:
+        cursor.close()
+        connection.close()
+
+    return saved
+
+
+def from_postgresql(region: Region, query):
+    """
+    fetch the rows of a select statement into a DataFrame through COPY ... TO STDOUT,
+    columns are parsed into typed numpy columns without creating a python object per row
+    """
+    db_engine = get_db_engine(region)
+    statement = query.compile(dialect=db_engine.dialect, compile_kwargs={"render_postcompile": True})
+
+    selected = [(name, col.type) for name, col in query.selected_columns.items()]
+    names = [name for name, _ in selected]
+    dtype, parse_dates, bools = copy_csv_types(selected)
+
+    connection = db_engine.raw_connection()
+    cursor = connection.cursor()
+
+    try:
+        sql = cursor.mogrify(str(statement), statement.params).decode('utf-8')
         store = StringIO()
-        cursor.copy_expert(copy_sql, store)
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV HEADER", store)
         store.seek(0)
-        ret = pd.read_csv(store)
+
+        ret = pd.read_csv(store, header=0, names=names, dtype=dtype, parse_dates=parse_dates,
+                          float_precision='round_trip')
+        for col in bools:
+            ret[col] = ret[col].map({'t': True, 'f': False})
     except Exception as e:
         logger.error(f'copy_expert failed on query: [ {query} ], {e}')
         ret = None
     finally:
         cursor.close()
         connection.close()
-        return ret
+
+    return ret
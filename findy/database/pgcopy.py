@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+import queue
+import struct
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, Numeric, SmallInteger, BigInteger, Integer, Boolean, DateTime, Date, String
+
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+# postgresql epoch 2000-01-01, in unix microseconds / days
+PG_EPOCH_US = 946684800 * 1000000
+PG_EPOCH_DAYS = 10957
+
+
+def binary_type(column_type):
+    """
+    map sqlalchemy column type to the binary encoder, None if not supported
+    """
+    if isinstance(column_type, Float):
+        return 'float8'
+    if isinstance(column_type, Numeric):
+        return None
+    if isinstance(column_type, SmallInteger):
+        return 'int2'
+    if isinstance(column_type, BigInteger):
+        return 'int8'
+    if isinstance(column_type, Integer):
+        return 'int4'
+    if isinstance(column_type, Boolean):
+        return 'bool'
+    if isinstance(column_type, DateTime):
+        return None if column_type.timezone else 'timestamp'
+    if isinstance(column_type, Date):
+        return 'date'
+    if isinstance(column_type, String):
+        return 'text'
+    return None
+
+
+def copy_csv_types(columns):
+    """
+    read_csv arguments to parse COPY ... TO STDOUT WITH CSV output into typed columns
+
+    columns: [(name, sqlalchemy column type)], returns (dtype, parse_dates, bools)
+    """
+    dtype = {}
+    parse_dates = []
+    bools = []
+    for name, column_type in columns:
+        if isinstance(column_type, (DateTime, Date)):
+            parse_dates.append(name)
+        elif isinstance(column_type, Boolean):
+            dtype[name] = object
+            bools.append(name)
+        elif isinstance(column_type, Float):
+            dtype[name] = 'float64'
+        elif isinstance(column_type, Integer):
+            dtype[name] = 'Int64'
+        elif isinstance(column_type, (Numeric, String)):
+            # keep codes like 000001 as they are
+            dtype[name] = 'float64' if isinstance(column_type, Numeric) else object
+    return dtype, parse_dates, bools
+
+
+def support_binary(table, columns) -> bool:
+    return all(col in table.c and binary_type(table.c[col].type) for col in columns)
+
+
+def _fixed(values: np.ndarray, null: np.ndarray, dtype: str):
+    width = np.dtype(dtype).itemsize
+    lengths = np.where(null, -1, width).astype(np.int64)
+    data = values[~null].astype(dtype).view(np.uint8)
+    return lengths, data
+
+
+def _numeric(series: pd.Series):
+    if series.dtype == object:
+        series = series.where(series != '', None)
+    return pd.to_numeric(series)
+
+
+# the boolean literals accepted by postgresql, lower cased, anything else is rejected
+bool_literals = {'t': True, 'true': True, 'y': True, 'yes': True, 'on': True, '1': True,
+                 'f': False, 'false': False, 'n': False, 'no': False, 'off': False, '0': False}
+
+
+def _boolean(series: pd.Series):
+    """
+    coerce series to a nullable boolean, strings are parsed as postgresql literals instead of
+    by python truthiness, so 'False' and '0' stay false, raise ValueError on other values
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series.astype('boolean')
+
+    def parse(value):
+        if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, str):
+            if value.strip() == '':
+                return None
+            parsed = bool_literals.get(value.strip().lower())
+        elif isinstance(value, (int, float, np.integer, np.floating)) and value in (0, 1):
+            parsed = bool(value)
+        else:
+            parsed = None
+        if parsed is None:
+            raise ValueError(f'invalid input for type boolean: {value!r}')
+        return parsed
+
+    return pd.Series([parse(value) for value in series.to_numpy()], index=series.index, dtype='boolean')
+
+
+def encode_column(series: pd.Series, pg_type: str):
+    """
+    encode one column to (lengths, data)
+
+    lengths: field byte length per row, -1 for null
+    data: payload bytes of the non null rows, concatenated in row order
+    """
+    if pg_type == 'text':
+        null = series.isna().to_numpy()
+        encoded = [v.encode('utf-8') if isinstance(v, str) else str(v).encode('utf-8')
+                   for v in series.to_numpy()[~null]]
+        lengths = np.full(len(series), -1, dtype=np.int64)
+        lengths[~null] = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        return lengths, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    if pg_type in ('timestamp', 'date'):
+        series = pd.to_datetime(series)
+        if series.dt.tz is not None:
+            # timestamp without time zone keeps the wall time, same as text COPY
+            series = series.dt.tz_localize(None)
+        null = series.isna().to_numpy()
+        if pg_type == 'timestamp':
+            values = series.to_numpy(dtype='datetime64[us]').view(np.int64) - PG_EPOCH_US
+            return _fixed(values, null, '>i8')
+        values = series.to_numpy(dtype='datetime64[D]').view(np.int64) - PG_EPOCH_DAYS
+        return _fixed(values, null, '>i4')
+
+    if pg_type == 'bool':
+        series = _boolean(series)
+        null = series.isna().to_numpy()
+        values = series.fillna(False).to_numpy(dtype=bool)
+        return _fixed(values, null, 'u1')
+
+    series = _numeric(series)
+    null = series.isna().to_numpy()
+
+    if pg_type == 'float8':
+        return _fixed(series.to_numpy(dtype=np.float64, na_value=np.nan), null, '>f8')
+
+    values = series.fillna(0).to_numpy(dtype=np.int64)
+    if pg_type == 'int2':
+        return _fixed(values, null, '>i2')
+    if pg_type == 'int4':
+        return _fixed(values, null, '>i4')
+    return _fixed(values, null, '>i8')
+
+
+def encode_rows(df: pd.DataFrame, table) -> bytes:
+    """
+    encode the rows of df as PGCOPY binary tuples, without header and trailer,
+    every column is written with vectorized scatters into one preallocated buffer
+    """
+    rows = len(df)
+    if rows == 0:
+        return b''
+
+    fields = [encode_column(df[col], binary_type(table.c[col].type)) for col in df.columns]
+
+    row_len = np.full(rows, 2, dtype=np.int64)
+    for lengths, _ in fields:
+        row_len += 4 + np.maximum(lengths, 0)
+
+    ends = np.cumsum(row_len)
+    starts = ends - row_len
+    buf = np.empty(int(ends[-1]), dtype=np.uint8)
+
+    # tuple field count
+    ncols = struct.pack('>h', len(fields))
+    buf[starts] = ncols[0]
+    buf[starts + 1] = ncols[1]
+
+    cursor = starts + 2
+    for lengths, data in fields:
+        buf[cursor[:, None] + np.arange(4)] = lengths.astype('>i4').view(np.uint8).reshape(rows, 4)
+
+        valid = lengths > 0
+        sizes = lengths[valid]
+        if len(sizes) > 0:
+            offsets = np.cumsum(sizes) - sizes
+            buf[np.repeat(cursor[valid] + 4 - offsets, sizes) + np.arange(len(data))] = data
+
+        cursor = cursor + 4 + np.maximum(lengths, 0)
+
+    return buf.tobytes()
+
+
+def to_pgcopy(df: pd.DataFrame, table) -> bytes:
+    return PGCOPY_HEADER + encode_rows(df, table) + PGCOPY_TRAILER
+
+
+def iter_csv_chunks(df: pd.DataFrame, chunk_rows: int):
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk.to_csv(sep='\t', index=False, header=False, encoding='utf-8').encode('utf-8')
+
+
+def iter_pgcopy_chunks(df: pd.DataFrame, table, chunk_rows: int):
+    yield PGCOPY_HEADER
+    for start in range(0, len(df), chunk_rows):
+        yield encode_rows(df.iloc[start:start + chunk_rows], table)
+    yield PGCOPY_TRAILER
+
+
+class CopyStream(object):
+    """
+    file-like reader over encoded chunks, for cursor.copy_from / copy_expert
+
+    chunks are produced by a background thread into a bounded queue, so the next
+    chunk is encoded while COPY is sending the current one, and at most
+    prefetch + 2 chunks are alive at any time
+    """
+    _end = object()
+
+    def __init__(self, chunks, prefetch: int = 1) -> None:
+        self.chunks = chunks
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stopped = False
+        self.buffer = memoryview(b'')
+        self.offset = 0
+        self.eof = False
+
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            for chunk in self.chunks:
+                if self.stopped:
+                    return
+                self.queue.put(chunk)
+            self.queue.put(self._end)
+        except Exception as e:
+            self.queue.put(e)
+
+    def _next_chunk(self) -> bool:
+        item = self.queue.get()
+        if item is self._end:
+            self.eof = True
+            return False
+        if isinstance(item, Exception):
+            self.eof = True
+            raise item
+        self.buffer = memoryview(item)
+        self.offset = 0
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while not self.eof and (size < 0 or size > 0):
+            if self.offset >= len(self.buffer) and not self._next_chunk():
+                break
+
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            parts.append(self.buffer[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+
+        return b''.join(parts)
+
+    def readline(self, size: int = -1) -> bytes:
+        # copy_from reads with read(), readline is here for the file protocol only
+        return self.read(size)
+
+    def close(self):
+        self.stopped = True
+        # unblock the producer if it is waiting on a full queue
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join(timeout=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -11,6 +11,7 @@ from findy.database.plugins.akshare.common import (to_ak_trading_level, to_ak_en
                                                    to_ak_trading_field, to_ak_adjust_flag)
 from findy.database.quote import get_entities
 from findy.utils.functool import time_it
+from findy.utils.limiter import report_throttled
 from findy.utils.pd import pd_valid
 from findy.utils.time import PD_TIME_FORMAT_DAY, PD_TIME_FORMAT_ISO8601, to_time_str
 
@@ -73,6 +74,7 @@ class AkChinaStockKdataRecorder(KDataRecorder):
         try:
             return _ak_get_bars(code, start, end, frequency, adjustflag)
         except Exception as e:
+            report_throttled(e)
             self.logger.error(f'ak_get_bars, frequency: {frequency}, code: {code}, error: {e}')
         return None
 
@@ -86,12 +88,13 @@ class AkChinaStockKdataRecorder(KDataRecorder):
         else:
             start = max(start, "1999-07-26")
 
-        df = self.ak_get_bars(to_ak_entity_id(entity),
-                               start=start,
-                               end=end if end is None else to_time_str(end),
-                               frequency=self.ak_trading_level,
-                               fields=to_ak_trading_field(self.ak_trading_level),
-                               adjustflag=to_ak_adjust_flag(self.adjust_type))
+        df = await self.run_request(self.ak_get_bars,
+                                    to_ak_entity_id(entity),
+                                    start=start,
+                                    end=end if end is None else to_time_str(end),
+                                    frequency=self.ak_trading_level,
+                                    fields=to_ak_trading_field(self.ak_trading_level),
+                                    adjustflag=to_ak_adjust_flag(self.adjust_type))
         # await asyncio.sleep(0.005)
 
         if pd_valid(df):
@@ -10,6 +10,7 @@ from findy.database.plugins.baostock.common import (to_bao_trading_level, to_bao
                                                     to_bao_trading_field, to_bao_adjust_flag)
 from findy.database.quote import get_entities
 from findy.utils.functool import time_it
+from findy.utils.limiter import report_throttled
 from findy.utils.pd import pd_valid
 from findy.utils.time import PD_TIME_FORMAT_DAY, PD_TIME_FORMAT_ISO8601, to_time_str
 
@@ -80,6 +81,7 @@ class BaoChinaStockKdataRecorder(KDataRecorder):
         try:
             return _bao_get_bars(code, start, end, frequency, adjustflag, fields)
         except Exception as e:
+            report_throttled(e)
             self.logger.error(f'bao_get_bars, frequency: {frequency}, code: {code}, error: {e}')
         return None
 
@@ -93,12 +95,13 @@ class BaoChinaStockKdataRecorder(KDataRecorder):
         else:
             start = max(start, "1999-07-26")
 
-        df = self.bao_get_bars(to_bao_entity_id(entity),
-                               start=start,
-                               end=end if end is None else to_time_str(end),
-                               frequency=self.bao_trading_level,
-                               fields=to_bao_trading_field(self.bao_trading_level),
-                               adjustflag=to_bao_adjust_flag(self.adjust_type))
+        df = await self.run_request(self.bao_get_bars,
+                                    to_bao_entity_id(entity),
+                                    start=start,
+                                    end=end if end is None else to_time_str(end),
+                                    frequency=self.bao_trading_level,
+                                    fields=to_bao_trading_field(self.bao_trading_level),
+                                    adjustflag=to_bao_adjust_flag(self.adjust_type))
         # await asyncio.sleep(0.005)
 
         if pd_valid(df):
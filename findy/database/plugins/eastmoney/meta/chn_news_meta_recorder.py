@@ -16,6 +16,7 @@ from findy.database.persist import df_to_db, to_postgresql
 from findy.database.quote import get_entities
 from findy.database.data_sources.news.eastmoney_streaming import Eastmoney_Streaming
 from findy.utils.functool import time_it
+from findy.utils.limiter import provider_request, report_throttled
 from findy.utils.time import now_pd_timestamp
 
 logger = logging.getLogger(__name__)
@@ -45,7 +46,7 @@ class EastMoneyChnNewsTitleRecorder(RecorderForEntities):
         src_id = EastMoneyChnNewsTitleRecorder.generate_domain_id(entity, src)
         return ref.id.isin(src_id).any()
 
-    def get_news_data(self, code, ref_record):
+    async def get_news_data(self, code, ref_record):
         # print(f"Collecting stock: {code}")
 
         # Detailed configs can be found here: https://www.kuaidaili.com/usercenter/tps/
@@ -61,8 +62,30 @@ class EastMoneyChnNewsTitleRecorder(RecorderForEntities):
         # ATTENTION! Should replace this with your results path!
         downloader = Eastmoney_Streaming(config)
         downloader.use_proxy = True
-        downloader.download_streaming_stock(code, EastMoneyChnNewsTitleRecorder.stop_get_page, ref_record, rounds=0)
-        return downloader.dataframe
+
+        # one provider request per page, instead of download_streaming_stock paging on its own
+        page = 1
+        error_count = 0
+        while True:
+            br = await self.run_request(self.gather_page, downloader, code, page, ref_record)
+            if br == "break":
+                break
+            elif br == "Error":
+                error_count += 1
+                if error_count > 10:
+                    logger.warning(f'news title of {code}: too many page errors, stop at page {page}')
+                    break
+            page += 1
+
+        return downloader.dataframe.reset_index(drop=True)
+
+    @staticmethod
+    def gather_page(downloader, code, page, ref_record):
+        br = downloader._gather_pages(code, page, EastMoneyChnNewsTitleRecorder.stop_get_page, ref_record)
+        # the downloader swallows the http errors, most of them are eastmoney refusing the crawler
+        if br == "Error":
+            report_throttled()
+        return br
 
     async def get_referenced_saved_record(self, entity, db_session):
         data, column_names = self.data_schema.query_data(
@@ -83,7 +106,7 @@ class EastMoneyChnNewsTitleRecorder(RecorderForEntities):
         ref_record = para
 
         # get news info
-        df = self.get_news_data(entity, ref_record)
+        df = await self.get_news_data(entity, ref_record)
 
         if df is None or len(df) == 0:
             return True, None
@@ -155,7 +178,10 @@ class EastMoneyChnNewsContentRecorder(RecorderForEntities):
 
         try:
             proxies = proxies["https"] if USE_PROXY else ''
-            async with http_session.get(url, headers=headers, proxy=proxies) as response:
+            async with provider_request(self.provider), \
+                    http_session.get(url, headers=headers, proxy=proxies) as response:
+                if response.status == 429:
+                    report_throttled()
                 text = await response.text()
                 res = etree.HTML(text)
                 res_df_part = res.xpath("//script[2]//text()")
@@ -46,7 +46,7 @@ class ChinaIndexListSpider(RecorderForEntities):
 
         while True:
             query_url = url.format(page, page_size)
-            text = sync_get(http_session, query_url, return_type='text')
+            text = await self.run_request(sync_get, http_session, query_url, return_type='text')
             if text is None:
                 continue
 
@@ -85,7 +85,7 @@ class ChinaIndexListSpider(RecorderForEntities):
         for _, index in df.iterrows():
             index_code = index['code']
             url = query_url.format(index_code)
-            content = sync_get(http_session, url, return_type='content')
+            content = await self.run_request(sync_get, http_session, url, return_type='content')
             if content is None:
                 self.logger.error(f'{index["name"]} - {index_code} 成分股抓取错误')
                 continue
@@ -122,7 +122,7 @@ class ChinaIndexListSpider(RecorderForEntities):
         抓取深证指数列表
         """
         url = 'http://www.szse.cn/api/report/ShowReport?SHOWTYPE=xlsx&CATALOGID=1812_zs&TABKEY=tab1'
-        content = sync_get(http_session, url, return_type='content')
+        content = await self.run_request(sync_get, http_session, url, return_type='content')
         if content is None:
             return
 
@@ -147,7 +147,7 @@ class ChinaIndexListSpider(RecorderForEntities):
             index_code = index['code']
 
             url = query_url.format(index_code)
-            content = sync_get(http_session, url, return_type='content')
+            content = await self.run_request(sync_get, http_session, url, return_type='content')
             if content is None:
                 continue
 
@@ -181,7 +181,7 @@ class ChinaIndexListSpider(RecorderForEntities):
         抓取国证指数列表
         """
         url = 'http://www.cnindex.com.cn/zstx/jcxl/'
-        text = sync_get(http_session, url, return_type='text')
+        text = await self.run_request(sync_get, http_session, url, return_type='text')
         if text is None:
             return
 
@@ -223,7 +223,7 @@ class ChinaIndexListSpider(RecorderForEntities):
             index_code = index['code']
 
             url = query_url.format(index_code)
-            content = sync_get(http_session, url, return_type='content')
+            content = await self.run_request(sync_get, http_session, url, return_type='content')
             if content is None:
                 continue
 
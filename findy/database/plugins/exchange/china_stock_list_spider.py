@@ -13,8 +13,9 @@ from findy.database.persist import df_to_db
 from findy.database.context import get_db_session
 from findy.utils.functool import time_it
 from findy.utils.kafka import connect_kafka_producer, publish_message
+from findy.utils.limiter import provider_request
 from findy.utils.progress import progress_topic, progress_key
-from findy.utils.request import get_async_http_session, chrome_copy_header_to_dict
+from findy.utils.request import get_worker_http_session, chrome_copy_header_to_dict
 from findy.utils.pd import pd_valid
 from findy.utils.time import to_pd_timestamp
 
@@ -69,13 +70,14 @@ class ExchangeChinaStockListRecorder(RecorderForEntities):
         return 'list_date'
 
     async def process_loop(self, item):
-        entity, pbar_update, concurrent = item
+        entity, pbar_update, concurrent, _ = item
         
         url = self.category_map_url.get(entity, None)
         assert url is not None
 
-        http_session = get_async_http_session()
-        async with http_session.get(url, headers=self.category_map_header[entity]) as response:
+        http_session = get_worker_http_session()
+        async with provider_request(self.provider), \
+                http_session.get(url, headers=self.category_map_header[entity]) as response:
             if response.status != 200:
                 return
 
@@ -90,8 +92,6 @@ class ExchangeChinaStockListRecorder(RecorderForEntities):
         pbar_update["update"] = 1
         publish_message(kafka_producer, progress_topic, progress_key,  msgpack.dumps(pbar_update))
 
-        await http_session.close()
-        
     def format(self, resp, exchange):
         df = None
         if exchange == ChnExchange.SSE.value:
@@ -144,7 +144,8 @@ class ExchangeChinaStockListRecorder(RecorderForEntities):
                        data_schema=StockDetail,
                        db_session=get_db_session(self.region, self.provider, StockDetail),
                        df=df,
-                       force_update=True)
+                       force_update=True,
+                       write_mode='upsert')
 
         return True, saved
 
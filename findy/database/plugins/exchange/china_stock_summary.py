@@ -8,6 +8,7 @@ from findy.database.schema.meta.stock_meta import Index
 from findy.database.schema.misc.overall import StockSummary
 from findy.database.recorder import TimestampsDataRecorder
 from findy.utils.functool import time_it
+from findy.utils.limiter import provider_request
 from findy.utils.request import chrome_copy_header_to_dict
 from findy.utils.time import to_time_str, now_pd_timestamp
 from findy.utils.convert import to_float
@@ -54,7 +55,8 @@ class StockSummaryRecorder(TimestampsDataRecorder):
             timestamp_str = to_time_str(timestamp)
             url = self.url.format(timestamp_str)
 
-            async with http_session.get(url, headers=DEFAULT_SH_SUMMARY_HEADER) as response:
+            async with provider_request(self.provider), \
+                    http_session.get(url, headers=DEFAULT_SH_SUMMARY_HEADER) as response:
                 if response.status != 200:
                     return True, None
 
@@ -10,7 +10,8 @@ from findy.database.recorder import RecorderForEntities
 from findy.database.persist import df_to_db
 from findy.database.context import get_db_session
 from findy.utils.functool import time_it
-from findy.utils.request import get_async_http_session
+from findy.utils.limiter import provider_request
+from findy.utils.request import get_worker_http_session
 from findy.utils.kafka import connect_kafka_producer, publish_message
 from findy.utils.progress import progress_topic, progress_key
 from findy.utils.time import to_pd_timestamp
@@ -46,15 +47,16 @@ class ExchangeUsStockListRecorder(RecorderForEntities):
         return 'list_date'
 
     async def process_loop(self, item):
-        entity, pbar_update, concurrent = item
+        entity, pbar_update, concurrent, _ = item
         
-        http_session = get_async_http_session()
+        http_session = get_worker_http_session()
 
         url = 'https://api.nasdaq.com/api/screener/stocks'
         params = {'download': 'true', 'exchange': entity}
 
         try:
-            async with http_session.get(url, headers=YAHOO_STOCK_LIST_HEADER, params=params) as response:
+            async with provider_request(self.provider), \
+                    http_session.get(url, headers=YAHOO_STOCK_LIST_HEADER, params=params) as response:
                 _json = await response.json()
                 _json = _json['data']['rows']
                 if _json is not None and len(_json) > 0:
@@ -66,8 +68,6 @@ class ExchangeUsStockListRecorder(RecorderForEntities):
 
         pbar_update["update"] = 1
         publish_message(kafka_producer, progress_topic, progress_key, msgpack.dumps(pbar_update))
-        
-        await http_session.close()
 
     def format(self, content, exchange):
         df = pd.DataFrame(content)
@@ -106,7 +106,8 @@ class ExchangeUsStockListRecorder(RecorderForEntities):
                        data_schema=StockDetail,
                        db_session=get_db_session(self.region, self.provider, StockDetail),
                        df=df,
-                       force_update=True)
+                       force_update=True,
+                       write_mode='upsert')
 
         return True, saved
 
@@ -118,7 +118,7 @@ class NewsDataUsNewsRecorder(RecorderForEntities):
         # Welsh              cy
         language = 'en'
         api = NewsDataApiClient(apikey=findy_config['newsdata.io'])
-        articles_result = self.request_news(api, entity, language)
+        articles_result = await self.request_news(api, entity, language)
         df = pd.DataFrame(articles_result)
         try:
             df.drop_duplicates(subset='article_id', keep='last', inplace=True)
@@ -166,11 +166,12 @@ class NewsDataUsNewsRecorder(RecorderForEntities):
 
         return search_list
 
-    def inner_request_news(self, api, keyword, language, page):
+    async def inner_request_news(self, api, keyword, language, page):
 
+        # every page and every retry is one provider request
         for _ in range(self.max_retry):
             try:
-                response = api.news_api(q=keyword, language=language, page=page)
+                response = await self.run_request(api.news_api, q=keyword, language=language, page=page)
                 if response is not None and response['status'] == 'success':
                     break
             except Exception as e:
@@ -179,12 +180,12 @@ class NewsDataUsNewsRecorder(RecorderForEntities):
 
         return response
 
-    def request_news(self, api, keywords, language, page=None):
+    async def request_news(self, api, keywords, language, page=None):
         articles_list = []
         totalResults = 0
         
         while True:
-            response = self.inner_request_news(api, keywords, language, page)
+            response = await self.inner_request_news(api, keywords, language, page)
 
             if response is not None:
                 totalResults = response['totalResults']
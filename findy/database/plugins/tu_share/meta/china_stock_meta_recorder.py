@@ -89,7 +89,8 @@ class TushareChinaStockDetailRecorder(RecorderForEntities):
                                data_schema=self.data_schema,
                                db_session=db_session,
                                df=df_record,
-                               force_update=True)
+                               force_update=True,
+                               write_mode='upsert')
         return True, saved
 
     @time_it
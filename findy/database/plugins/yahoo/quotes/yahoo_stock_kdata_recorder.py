@@ -84,10 +84,10 @@ class YahooUsStockKdataRecorder(KDataRecorder):
             try:
                 code = entity.code
                 if self.level < IntervalLevel.LEVEL_1DAY:
-                    df = Ticker(code).history(period="3mon", interval=to_yahoo_trading_level(self.level), proxy=proxies, debug=False)
+                    df = await self.run_request(Ticker(code).history, period="3mon", interval=to_yahoo_trading_level(self.level), proxy=proxies, debug=False)
                     # df, msg = await Yahoo.fetch(http_session, 'US/Eastern', code, interval=to_yahoo_trading_level(self.level), period="3mon", proxy=proxies)
                 else:
-                    df = Ticker(code).history(start=start, end=end, interval=to_yahoo_trading_level(self.level), proxy=proxies, debug=False)
+                    df = await self.run_request(Ticker(code).history, start=start, end=end, interval=to_yahoo_trading_level(self.level), proxy=proxies, debug=False)
                     # df, msg = await Yahoo.fetch(http_session, 'US/Eastern', code, interval=to_yahoo_trading_level(self.level), start=start, end=end, proxy=proxies)
                 return df
             except Exception as e:
@@ -98,6 +98,7 @@ class YahooUsStockKdataRecorder(KDataRecorder):
                 if isinstance(msg, str) and ("Server disconnected" in msg or
                                              "Cannot connect to host" in msg or
                                              "Internal Privoxy Error" in msg):
+                    # back off outside of the provider request, its slot is free meanwhile
                     await self.sleep(60 * 10)
                 else:
                     break
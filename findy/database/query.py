@@ -4,16 +4,19 @@ from typing import List, Union
 # import time
 import pandas as pd
 
+from sqlalchemy import select, func
 from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import InstrumentedAttribute
 
-# from findy import findy_config
+from findy import findy_config
 from findy.interface import Region, Provider
 from findy.database.schema import IntervalLevel
 from findy.database.schema.register import providers
 # from findy.database.context import  profiled
-# from findy.database.persist import from_postgresql
 from findy.utils.time import PRECISION_STR, to_pd_timestamp
-# from findy.utils.pd import pd_valid, index_df
+from findy.utils.pd import pd_valid, index_df
+from findy.database.query_cache import get_query_cache, table_generation
+from findy.database.statement import get_schema_column, get_schema_columns_of, select_statement
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +47,7 @@ def common_filter(query: Query,
     if ids is not None:
         query = query.filter(data_schema.id.in_(ids))
 
-    time_col = eval(f'data_schema.{time_field}')
+    time_col = get_schema_column(data_schema, time_field)
 
     if start_timestamp:
         query = query.filter(time_col >= to_pd_timestamp(start_timestamp))
@@ -69,11 +72,11 @@ def column_query(data_schema, db_session, columns, time_field, col_label):
         columns_ = []
         for col in columns:
             assert isinstance(col, str)
-            columns_.append(eval(f'data_schema.{col}'))
+            columns_.append(get_schema_column(data_schema, col))
         columns = columns_
 
     # make sure get timestamp
-    time_col = eval(f'data_schema.{time_field}')
+    time_col = get_schema_column(data_schema, time_field)
     if time_col not in columns:
         columns.append(time_col)
 
@@ -89,6 +92,110 @@ def column_query(data_schema, db_session, columns, time_field, col_label):
     return db_session.query(*columns)
 
 
+def template_order(order, time_col):
+    """
+    'asc' or 'desc' if order is on time_col, False for any other order
+    """
+    if order is None:
+        return None
+    if order.compare(time_col.desc()):
+        return 'desc'
+    if order.compare(time_col.asc()) or order.compare(time_col.expression):
+        return 'asc'
+    return False
+
+
+def template_statement(data_schema,
+                       columns: List = None,
+                       ids: List[str] = None,
+                       entity_ids: List[str] = None,
+                       entity_id: str = None,
+                       codes: List[str] = None,
+                       code: str = None,
+                       start_timestamp=None,
+                       end_timestamp=None,
+                       order=None,
+                       limit: int = None,
+                       time_field='timestamp'):
+    """
+    the cached select_statement of the query shape bound to its values,
+    None if the shape is not a template one, which is then built by column_query and common_filter
+    """
+    keys = [(name, value) for name, value in [('ids', ids), ('entity_ids', entity_ids), ('entity_id', entity_id),
+                                              ('codes', codes), ('code', code)] if value is not None]
+    if len(keys) > 1:
+        return None
+
+    names = None
+    if columns:
+        names = []
+        for col in columns:
+            if isinstance(col, str):
+                names.append(col)
+            elif isinstance(col, InstrumentedAttribute) and col.class_ is data_schema:
+                names.append(col.key)
+            else:
+                return None
+        # make sure get timestamp
+        if time_field not in names:
+            names.append(time_field)
+        names = tuple(names)
+
+    time_order = template_order(order, get_schema_column(data_schema, time_field))
+    if time_order is False:
+        return None
+
+    params = dict(keys)
+    if start_timestamp:
+        params['start_timestamp'] = to_pd_timestamp(start_timestamp)
+    if end_timestamp:
+        params['end_timestamp'] = to_pd_timestamp(end_timestamp)
+    if limit:
+        params['limit'] = limit
+
+    statement = select_statement(data_schema, names,
+                                 by=keys[0][0] if keys else None,
+                                 start='start_timestamp' in params,
+                                 end='end_timestamp' in params,
+                                 order=time_order,
+                                 limit='limit' in params,
+                                 time_field=time_field)
+    return statement.params(**params) if params else statement
+
+
+def fetch_data(region: Region, data_schema, db_session, statement, columns, fun, index, time_field, order, return_type):
+    if return_type == 'df' and fun is None:
+        from findy.database.persist import from_postgresql
+
+        df = from_postgresql(region, statement)
+        if df is None:
+            return None, []
+
+        if pd_valid(df) and index:
+            # keep the rows in the order asked for, if any
+            if order is None:
+                df = index_df(df, index=index, time_field=time_field)
+            else:
+                df = df.set_index(index, drop=False)
+        return df, df.columns.tolist()
+
+    try:
+        result = db_session.execute(statement)
+        result_columns = statement.selected_columns.keys()
+    except Exception as e:
+        logger.error(f"query {data_schema.__tablename__} failed with error: {e}")
+        return None, []
+
+    if columns:
+        result = result.all()
+    elif fun is not None:
+        result = result.scalar()
+    else:
+        result = result.scalars().all()
+
+    return (result, result_columns)
+
+
 def get_data(
         region: Region,
         provider: Provider,
@@ -109,7 +216,15 @@ def get_data(
         limit: int = None,
         index: Union[str, list] = None,
         time_field: str = 'timestamp',
-        fun=None):
+        fun=None,
+        return_type: str = None):
+    """
+    query data_schema, returns (rows, column names)
+
+    rows are ORM instances, or row tuples if columns is set, with return_type='df' they are
+    fetched with COPY into a DataFrame instead, indexed by index if set, and sorted by it unless
+    order is set, rows are (None, []) if the query failed
+    """
     assert data_schema is not None
     assert db_session is not None
     assert provider is not None
@@ -117,91 +232,187 @@ def get_data(
 
     # now = time.time()
 
-    if columns:
-        query = column_query(data_schema, db_session, columns, time_field, col_label)
-    elif fun is not None:
-        query = db_session.query(fun)
-    else:
-        query = db_session.query(data_schema)
-
-    # if findy_config['debug'] == 2:
-    #     cost = PRECISION_STR.format(time.time() - now)
-    #     logger.debug(f"get_data query column: {cost}")
-
-    query = common_filter(query,
-                          data_schema=data_schema,
-                          ids=ids,
-                          entity_ids=entity_ids,
-                          entity_id=entity_id,
-                          codes=codes,
-                          code=code,
-                          start_timestamp=start_timestamp,
-                          end_timestamp=end_timestamp,
-                          filters=filters,
-                          order=order,
-                          limit=limit,
-                          time_field=time_field)
+    statement = None
+    if not filters and not col_label and fun is None:
+        statement = template_statement(data_schema, columns, ids=ids, entity_ids=entity_ids, entity_id=entity_id,
+                                       codes=codes, code=code, start_timestamp=start_timestamp,
+                                       end_timestamp=end_timestamp, order=order, limit=limit, time_field=time_field)
+
+    if statement is None:
+        if columns:
+            query = column_query(data_schema, db_session, columns, time_field, col_label)
+        elif fun is not None:
+            query = db_session.query(fun)
+        else:
+            query = db_session.query(data_schema)
+
+        # if findy_config['debug'] == 2:
+        #     cost = PRECISION_STR.format(time.time() - now)
+        #     logger.debug(f"get_data query column: {cost}")
+
+        query = common_filter(query,
+                              data_schema=data_schema,
+                              ids=ids,
+                              entity_ids=entity_ids,
+                              entity_id=entity_id,
+                              codes=codes,
+                              code=code,
+                              start_timestamp=start_timestamp,
+                              end_timestamp=end_timestamp,
+                              filters=filters,
+                              order=order,
+                              limit=limit,
+                              time_field=time_field)
+        statement = query.statement
     # if not db_session:
     #     db_session = get_db_session(region, provider, data_schema)
 
-    try:
-        result = db_session.execute(query)
-        result_columns = query.statement.columns.keys()
-    except Exception as e:
-        logger.error(f"query {data_schema.__tablename__} failed with error: {e}")
-        return None, []
+    query_cache = get_query_cache()
+    # ORM instances are bound to their session and mutable, only frames, row tuples and scalars are cached
+    if query_cache is None or (return_type != 'df' and not columns and fun is None):
+        return fetch_data(region, data_schema, db_session, statement, columns, fun, index, time_field, order, return_type)
+
+    # read the generation before the query, a write racing with it invalidates the entry
+    generation = table_generation(region, data_schema.__tablename__)
+    key = query_cache.key(region, statement, db_session.get_bind().dialect,
+                          return_type, index, time_field, fun is not None)
+
+    ret = query_cache.get(key, generation)
+    if ret is None:
+        ret = fetch_data(region, data_schema, db_session, statement, columns, fun, index, time_field, order, return_type)
+        if ret[0] is not None:
+            query_cache.put(key, generation, ret)
+    return ret
+
+
+def get_window_data(
+        region: Region,
+        provider: Provider,
+        data_schema,
+        db_session,
+        window: int,
+        entity_ids: List[str] = None,
+        columns: List = None,
+        start_timestamp: Union[pd.Timestamp, str] = None,
+        end_timestamp: Union[pd.Timestamp, str] = None,
+        filters: List = None,
+        index: Union[str, list] = None,
+        time_field: str = 'timestamp'):
+    """
+    the latest window rows of every entity in one statement, returns (DataFrame, column names)
+
+    rows are ranked by ROW_NUMBER() OVER (PARTITION BY entity_id ORDER BY time_field DESC)
+    and fetched with COPY, instead of one limit query per entity
+    """
+    assert data_schema is not None
+    assert db_session is not None
+    assert provider is not None
+    assert provider in providers[region]
+
+    time_col = get_schema_column(data_schema, time_field)
+    entity_col = get_schema_column(data_schema, 'entity_id')
 
     if columns:
-        result = result.all()
-    elif fun is not None:
-        result = result.scalar()
+        cols = get_schema_columns_of(data_schema, columns)
+        cols += [col for col in (entity_col, time_col) if col not in cols]
     else:
-        result = result.scalars().all()
+        cols = [get_schema_column(data_schema, col.key) for col in data_schema.__table__.columns]
 
-    # if findy_config['debug'] == 2:
-    #     cost = PRECISION_STR.format(time.time() - now)
-    #     logger.debug(f"get_data query common: {cost}")
-
-    # if fun is not None:
-    #     # result = query.scalar()
-    #     result = db_session.execute(query).scalars().all()
-    #     return (result, query.statement.columns.keys())
-
-    # if return_type == 'df':
-    #     df = from_postgresql(region, query.statement)
-    #     if pd_valid(df) and index:
-    #         df = index_df(df, index=index, time_field=time_field)
-    #     else:
-    #         df = pd.DataFrame()
-    #     return df
-
-    # if return_type == 'df':
-    #     df = pd.read_sql(query.statement, query.session.bind)
-    #     if pd_valid(df) and index:
-    #         df = index_df(df, index=index, time_field=time_field)
-    #     return df
-
-    # if findy_config['debug'] == 2:
-    #     with profiled():
-    #         # result = query.all()
-    #         result = db_session.execute(query).all()
-    # else:
-        # result = query.all()
-
-    # if findy_config['debug'] == 2:
-    #     cost = PRECISION_STR.format(time.time() - now)
-    #     res_cnt = len(result) if result else 0
-    #     logger.debug(f"get_data do query cost: {cost}  limit: {limit} size: {res_cnt}")
-
-    # if return_type == 'df':
-    #     if len(result) > 0:
-    #         df = pd.DataFrame(result, columns=result[0].keys())
-    #         df.set_index('id', drop=True, inplace=True)
-    #     else:
-    #         df = pd.DataFrame()
-
-    #     if pd_valid(df) and index:
-    #         df = index_df(df, index=index, time_field=time_field)
-    #     return df
+    row_number = func.row_number().over(partition_by=entity_col, order_by=time_col.desc()).label('window_row')
+    ranked = select(*cols, row_number)
+    if entity_ids is not None:
+        ranked = ranked.where(entity_col.in_(entity_ids))
+    if start_timestamp:
+        ranked = ranked.where(time_col >= to_pd_timestamp(start_timestamp))
+    if end_timestamp:
+        ranked = ranked.where(time_col <= to_pd_timestamp(end_timestamp))
+    if filters is not None and len(filters) > 0:
+        ranked = ranked.where(*filters)
+    ranked = ranked.subquery()
 
-    return (result, result_columns)
+    statement = select(*[ranked.c[col.key] for col in cols]).where(ranked.c.window_row <= window)
+
+    from findy.database.persist import from_postgresql
+
+    df = from_postgresql(region, statement)
+    if df is None or len(df) == 0:
+        return pd.DataFrame(), []
+
+    if index:
+        df = index_df(df, index=index, time_field=time_field)
+    return df, df.columns.tolist()
+
+
+def get_data_iter(
+        region: Region,
+        provider: Provider,
+        data_schema,
+        db_session,
+        ids: List[str] = None,
+        entity_ids: List[str] = None,
+        entity_id: str = None,
+        codes: List[str] = None,
+        code: str = None,
+        level: Union[IntervalLevel, str] = None,
+        columns: List = None,
+        col_label: dict = None,
+        start_timestamp: Union[pd.Timestamp, str] = None,
+        end_timestamp: Union[pd.Timestamp, str] = None,
+        filters: List = None,
+        order=None,
+        limit: int = None,
+        index: Union[str, list] = None,
+        time_field: str = 'timestamp',
+        chunk_size: int = None):
+    """
+    streaming variant of get_data, yields DataFrame chunks of chunk_size rows
+
+    rows are fetched through a named server side cursor, so memory is bounded
+    by the chunk size whatever the size of the scanned range
+    """
+    assert data_schema is not None
+    assert db_session is not None
+    assert provider is not None
+    assert provider in providers[region]
+
+    if chunk_size is None:
+        chunk_size = findy_config.get('query_chunk_size', 100000)
+
+    statement = None
+    if not filters and not col_label:
+        statement = template_statement(data_schema, columns, ids=ids, entity_ids=entity_ids, entity_id=entity_id,
+                                       codes=codes, code=code, start_timestamp=start_timestamp,
+                                       end_timestamp=end_timestamp, order=order, limit=limit, time_field=time_field)
+
+    if statement is None:
+        if columns:
+            query = column_query(data_schema, db_session, columns, time_field, col_label)
+        else:
+            query = db_session.query(data_schema)
+
+        query = common_filter(query,
+                              data_schema=data_schema,
+                              ids=ids,
+                              entity_ids=entity_ids,
+                              entity_id=entity_id,
+                              codes=codes,
+                              code=code,
+                              start_timestamp=start_timestamp,
+                              end_timestamp=end_timestamp,
+                              filters=filters,
+                              order=order,
+                              limit=limit,
+                              time_field=time_field)
+
+        # core statement, rows are plain tuples instead of ORM instances
+        statement = query.statement
+    result_columns = statement.selected_columns.keys()
+
+    with db_session.get_bind().connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(statement)
+
+        for rows in result.partitions(chunk_size):
+            df = pd.DataFrame.from_records(rows, columns=result_columns, coerce_float=True)
+            if index:
+                df = index_df(df, index=index, time_field=time_field)
+            yield df
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from findy import findy_config, findy_env
+from findy.interface import Region
+
+logger = logging.getLogger(__name__)
+
+# the process wide query cache, created on first use
+__query_cache = None
+
+
+def generation_path(region: Region, tablename: str) -> str:
+    return os.path.join(findy_env['cache_path'], 'query_generation', f'{region.value}_{tablename}')
+
+
+def table_generation(region: Region, tablename: str) -> int:
+    """
+    generation counter of a table, the mtime of its generation file,
+    so writes from the recorder worker processes are seen by every process
+    """
+    try:
+        return os.stat(generation_path(region, tablename)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def bump_generation(region: Region, tablename: str):
+    """
+    invalidate the cached results of a table, called after every committed write
+    """
+    path = generation_path(region, tablename)
+    now = time.time_ns()
+    try:
+        try:
+            open(path, 'a').close()
+        except FileNotFoundError:
+            # the generation directory is created by the first bump, lookups before it read 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'a').close()
+        # mtime must move forward even if the clock tick is coarse
+        previous = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(now, max(now, previous + 1)))
+    except OSError as e:
+        logger.warning(f'bump generation of table: [ {tablename} ] failed, {e}')
+
+
+def tables_written_since(region: Region, since: int) -> list:
+    """
+    the tables of region with a write committed since the time.time_ns() timestamp since, by any process
+    """
+    path = os.path.dirname(generation_path(region, ''))
+    prefix = f'{region.value}_'
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name[len(prefix):] for entry in entries
+                    if entry.name.startswith(prefix) and entry.stat().st_mtime_ns >= since]
+    except FileNotFoundError:
+        return []
+
+
+def estimate_size(value) -> int:
+    # (rows, column names) of get_data
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[1], list):
+        return estimate_size(value[0]) + sys.getsizeof(value[1])
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return sys.getsizeof(value)
+        # sample the row tuples
+        sample = value[:100]
+        row = sum(sys.getsizeof(v) + sum(sys.getsizeof(f) for f in v) for v in sample) / len(sample)
+        return int(sys.getsizeof(value) + row * len(value))
+
+    return sys.getsizeof(value)
+
+
+def copy_result(value):
+    # callers modify the returned frames in place, rows are immutable tuples
+    if isinstance(value, tuple):
+        return tuple(copy_result(v) for v in value)
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+class QueryCache(object):
+    """
+    LRU + TTL cache of query results, bounded by the estimated result bytes
+
+    entries are keyed by the compiled statement with its parameters and
+    are dropped once the generation of their table moves on
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (value, size, expire time, tablename generation)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(region: Region, statement, dialect, *extra) -> str:
+        compiled = statement.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+        params = sorted((k, repr(v)) for k, v in compiled.params.items())
+        return f'{region.value}|{compiled}|{params}|{extra}'
+
+    def _remove(self, key):
+        _, size, _, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key: str, generation: int):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expire, cached_generation = entry
+            if cached_generation != generation:
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            if expire < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy_result(value)
+
+    def put(self, key: str, generation: int, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        value = copy_result(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, size, time.time() + self.ttl, generation)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else 0.0,
+                    'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
+
+
+def get_query_cache():
+    """
+    the process wide query cache, None if disabled by query_cache_bytes
+    """
+    global __query_cache
+
+    max_bytes = findy_config.get('query_cache_bytes', 0)
+    if max_bytes <= 0:
+        return None
+
+    if __query_cache is None:
+        __query_cache = QueryCache(max_bytes=max_bytes, ttl=findy_config.get('query_cache_ttl', 300))
+    return __query_cache
+
+
+def query_cache_stats() -> dict:
+    query_cache = get_query_cache()
+    return query_cache.stats() if query_cache is not None else {}
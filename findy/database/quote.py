@@ -62,7 +62,8 @@ def get_entities(
         filters: List = None,
         order=None,
         limit: int = None,
-        index: Union[str, list] = 'code') -> object:
+        index: Union[str, list] = 'code',
+        return_type: str = None) -> object:
     if not entity_schema:
         entity_schema = get_entity_schema_by_type(entity_type)
 
@@ -81,7 +82,7 @@ def get_entities(
         codes=codes, code=code, level=None, columns=columns,
         col_label=col_label, start_timestamp=start_timestamp,
         end_timestamp=end_timestamp, filters=filters,
-        order=order, limit=limit, index=index)
+        order=order, limit=limit, index=index, return_type=return_type)
 
 
 def get_data_count(data_schema, db_session, filters=None):
@@ -232,7 +233,7 @@ async def get_portfolio_stocks(region: Region, provider: Provider, timestamp, po
     if latests and len(latests) > 0:
         latest_record = latests[0]
         # 获取最新的报表
-        data, column_names = data_schema.query_data(
+        df, column_names = data_schema.query_data(
             region=region,
             provider=provider,
             db_session=db_session,
@@ -240,10 +241,10 @@ async def get_portfolio_stocks(region: Region, provider: Provider, timestamp, po
             codes=codes,
             ids=ids,
             end_timestamp=timestamp,
-            filters=[data_schema.report_date == latest_record.report_date])
+            filters=[data_schema.report_date == latest_record.report_date],
+            return_type='df')
 
-        if data and len(data) > 0:
-            df = pd.DataFrame([s.__dict__ for s in data], columns=column_names)
+        if pd_valid(df):
 
             # 最新的为年报或者半年报
             if latest_record.report_period == ReportPeriod.year or latest_record.report_period == ReportPeriod.half_year:
@@ -254,7 +255,7 @@ async def get_portfolio_stocks(region: Region, provider: Provider, timestamp, po
                 while step <= 20:
                     report_date = get_recent_report_date(latest_record.report_date, step=step)
 
-                    data, column_names = data_schema.query_data(
+                    pre_df, column_names = data_schema.query_data(
                         region=region,
                         provider=provider,
                         db_session=db_session,
@@ -262,18 +263,18 @@ async def get_portfolio_stocks(region: Region, provider: Provider, timestamp, po
                         codes=codes,
                         ids=ids,
                         end_timestamp=timestamp,
-                        filters=[data_schema.report_date == to_pd_timestamp(report_date)])
+                        filters=[data_schema.report_date == to_pd_timestamp(report_date)],
+                        return_type='df')
 
-                    if data and len(data) > 0:
-                        pre_df = pd.DataFrame.from_records([s.__dict__ for s in data], columns=column_names)
+                    if pd_valid(pre_df):
                         df = df.append(pre_df)
 
-                    # 半年报和年报
-                    if (ReportPeriod.half_year.value in pre_df['report_period'].tolist()) or (
-                            ReportPeriod.year.value in pre_df['report_period'].tolist()):
-                        # 保留最新的持仓
-                        df = df.drop_duplicates(subset=['stock_code'], keep='first')
-                        return df
+                        # 半年报和年报
+                        if (ReportPeriod.half_year.value in pre_df['report_period'].tolist()) or (
+                                ReportPeriod.year.value in pre_df['report_period'].tolist()):
+                            # 保留最新的持仓
+                            df = df.drop_duplicates(subset=['stock_code'], keep='first')
+                            return df
                     step = step + 1
 
 
@@ -302,7 +303,7 @@ async def get_kdata(region: Region, entity_id=None, entity_ids=None,
     entity_type, exchange, code = decode_entity_id(entity_id)
     data_schema: Mixin = get_kdata_schema(entity_type, level=level, adjust_type=adjust_type)
 
-    data, column_names = data_schema.query_data(
+    df, column_names = data_schema.query_data(
         region=region,
         provider=provider,
         db_session=db_session,
@@ -314,9 +315,7 @@ async def get_kdata(region: Region, entity_id=None, entity_ids=None,
         filters=filters,
         order=order,
         limit=limit,
-        index=index)
+        index=index,
+        return_type='df')
 
-    if data and not columns:
-        return pd.DataFrame([s.__dict__ for s in data], columns=column_names)
-
-    return pd.DataFrame(data, columns=column_names)
+    return df if df is not None else pd.DataFrame()
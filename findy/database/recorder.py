@@ -6,7 +6,9 @@ import time
 import msgpack
 import math
 import asyncio
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import contextvars
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import pandas as pd
 
@@ -18,7 +20,10 @@ from findy.database.schema.quotes.trade_day import StockTradeDay
 from findy.database.schema.register import get_schema_by_name
 from findy.database.context import get_db_session
 from findy.database.quote import get_entities
-from findy.utils.request import get_async_http_session
+from findy.database.watermark import prepare_watermarks, get_latest_timestamp, get_latest_timestamps
+from findy.database.worker import entity_worker, get_worker_pool
+from findy.utils.request import get_worker_http_session
+from findy.utils.limiter import get_rate_limiter, get_provider_executor, provider_request
 from findy.utils.kafka import connect_kafka_producer, publish_message
 from findy.utils.progress import progress_topic, progress_key
 from findy.utils.pd import pd_valid
@@ -107,6 +112,31 @@ class RecorderForEntities(Recorder):
             codes=self.codes)
         return entities
 
+    async def pre_eval(self, entities, db_session):
+        """
+        evaluate the entities in the main process before dispatching them,
+        returns the (entity, eval result) still to record, eval result None to evaluate in the worker
+        """
+        return [(entity, None) for entity in entities]
+
+    async def run_sync(self, fn, *args, **kwargs):
+        """
+        run the blocking sdk call fn on the thread pool of the provider, so the event loop keeps
+        the other entities of the worker going meanwhile, fn sees the provider request of the caller
+        """
+        context = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(get_provider_executor(self.provider),
+                                                              functools.partial(context.run, fn, *args, **kwargs))
+
+    async def run_request(self, fn, *args, **kwargs):
+        """
+        one request to the provider by the blocking sdk call fn, within the request budget of
+        the provider shared by all the workers, call it per request, not per entity, so pagers
+        and retries are limited as well and no slot is held while backing off between them
+        """
+        async with provider_request(self.provider):
+            return await self.run_sync(fn, *args, **kwargs)
+
     async def eval(self, entity, http_session, db_session):
         raise NotImplementedError
 
@@ -122,62 +152,45 @@ class RecorderForEntities(Recorder):
     async def on_finish(self, entities):
         raise NotImplementedError
 
-    async def __process_entity(self, entity, http_session, db_session, concurrent):
+    async def __process_entity(self, entity, http_session, db_session, evaluated=None):
         eval_time = 0
         download_time = 0
         persist_time = 0
 
         start_point = time.time()
 
-        # eval
-        eval_time, (is_finish, para) = await self.eval(entity, http_session, db_session)
+        # eval, unless it was done by pre_eval
+        if evaluated is None:
+            eval_time, (is_finish, para) = await self.eval(entity, http_session, db_session)
+        else:
+            is_finish, para = evaluated
 
         # data is up to date
         if is_finish:
             return 1, eval_time, download_time, persist_time, time.time() - start_point, None
 
-        async with asyncio.Semaphore(concurrent):
-            start_point = time.time()
+        start_point = time.time()
 
-            # fetch
-            download_time, (is_finish, df_record) = await self.record(entity, http_session, db_session, para)
-            if is_finish:
-                # await self.sleep(0.1)
-                return 2, eval_time, download_time, persist_time, time.time() - start_point + eval_time, None
+        # fetch
+        download_time, (is_finish, df_record) = await self.record(entity, http_session, db_session, para)
+        if is_finish:
+            # await self.sleep(0.1)
+            return 2, eval_time, download_time, persist_time, time.time() - start_point + eval_time, None
 
-            # save
-            persist_time, (is_finish, extra) = await self.persist(entity, http_session, db_session, df_record)
-            if is_finish:
-                # await self.sleep(0.1)
-                return 3, eval_time, download_time, persist_time, time.time() - start_point + eval_time, extra
+        # save
+        persist_time, (is_finish, extra) = await self.persist(entity, http_session, db_session, df_record)
+        if is_finish:
+            # await self.sleep(0.1)
+            return 3, eval_time, download_time, persist_time, time.time() - start_point + eval_time, extra
 
         return 0, eval_time, download_time, persist_time, time.time() - start_point + eval_time, None
 
-    async def process_loop(self, item):
-        entity, pbar_update, concurrent = item
-
-        http_session = get_async_http_session()
-        db_session = get_db_session(self.region, self.provider, self.data_schema)
-
-        eval_time = 0
-        download_time = 0
-        persist_time = 0
-        total_time = 0
-
-        while True:
-            result, eval_, download_, persist_, total_, extra = await self.__process_entity(entity, http_session, db_session, concurrent)
-            eval_time += eval_
-            download_time += download_
-            persist_time += persist_
-            total_time += total_
-
-            if result > 0:
-                # add finished entity to finished_items
-                time, _ = await self.on_finish_entity(entity, http_session, db_session, result)
-                total_time += time
-                break
-
+    def report(self, entity, pbar_update, eval_time, download_time, persist_time, total_time, extra):
         pbar_update["update"] = 1
+        limiter = get_rate_limiter(self.provider)
+        if limiter is not None:
+            limit, errors = limiter.stats()
+            pbar_update["postfix"] = f"limit: {limit:.1f}, errors: {errors:.1%}"
         publish_message(kafka_producer, progress_topic, progress_key, msgpack.dumps(pbar_update))
 
         eval_time = PRECISION_STR.format(eval_time)
@@ -202,17 +215,57 @@ class RecorderForEntities(Recorder):
             self.logger.info("{}{:>17}, {:>18}, eval: {}, download: {}, persist: {}, total: {}{}".format(
                 prefix, self.data_schema.__name__, name, eval_time, download_time, persist_time, total_time, postfix))
 
-        await http_session.close()
+    async def process_loop(self, item):
+        entity, pbar_update, concurrent, evaluated = item
+
+        http_session = get_worker_http_session()
+        db_session = get_db_session(self.region, self.provider, self.data_schema)
+
+        eval_time = 0
+        download_time = 0
+        persist_time = 0
+        total_time = 0
+
+        while True:
+            result, eval_, download_, persist_, total_, extra = await self.__process_entity(entity, http_session, db_session, evaluated)
+            # the data saved since, evaluate again in next loop
+            evaluated = None
+            eval_time += eval_
+            download_time += download_
+            persist_time += persist_
+            total_time += total_
+
+            if result > 0:
+                # add finished entity to finished_items
+                time, _ = await self.on_finish_entity(entity, http_session, db_session, result)
+                total_time += time
+                break
+
+        # saved counts are known only after the write buffer flushed
+        if isinstance(extra, list) and isinstance(extra[0], Future):
+            extra[0].add_done_callback(
+                lambda future: self.report(entity, pbar_update, eval_time, download_time, persist_time, total_time,
+                                           [future.result()] + extra[1:]))
+        else:
+            self.report(entity, pbar_update, eval_time, download_time, persist_time, total_time, extra)
+
+    async def process_shard(self, items):
+        """
+        record the items of one worker concurrently on its event loop
+        """
+        concurrent = items[0][2]
+        semaphore = asyncio.Semaphore(concurrent)
+
+        async def process(item):
+            async with semaphore:
+                await self.process_loop(item)
 
-    @staticmethod
-    def async_to_sync(corofn, *args):
-        loop = asyncio.new_event_loop()
         try:
-            coro = corofn(*args)
-            asyncio.set_event_loop(loop)
-            return loop.run_until_complete(coro)
+            await asyncio.gather(*[process(item) for item in items])
         finally:
-            loop.close()
+            # the worker outlives the run, saved counts are due when the shard returns
+            from findy.database.buffer import flush_write_buffers
+            flush_write_buffers()
 
     async def run(self):
         db_session = get_db_session(self.region, self.provider, self.data_schema)
@@ -221,22 +274,44 @@ class RecorderForEntities(Recorder):
         if entities and len(entities) > 0:
             taskid, processor, concurrent, desc = self.share_para[0:4]
 
-            pbar_update = {"task": taskid, "total": len(entities), "desc": desc, "leave": True, "update": 0}
-            publish_message(kafka_producer, progress_topic, progress_key, msgpack.dumps(pbar_update))
+            # up to date entities are not dispatched at all
+            pending = [(entity, evaluated) for entity, evaluated in await self.pre_eval(entities, db_session)
+                       if evaluated is None or not evaluated[0]]
+            if len(pending) < len(entities):
+                self.logger.info(f'{self.data_schema.__name__}, up to date: {len(entities) - len(pending)}, '
+                                 f'to record: {len(pending)}')
 
-            items = [(entity, pbar_update, concurrent) for entity in entities]
+            if pending:
+                pbar_update = {"task": taskid, "total": len(pending), "desc": desc, "leave": True, "update": 0}
+                publish_message(kafka_producer, progress_topic, progress_key, msgpack.dumps(pbar_update))
 
-            with ProcessPoolExecutor(max_workers=processor) as pool:
-                loop = asyncio.get_event_loop()
-                tasks = [loop.run_in_executor(pool, self.async_to_sync, self.process_loop, item) for item in items]
+                # an entity always goes to the same worker, so the caches of the worker stay warm
+                shards = [[] for _ in range(processor)]
+                for entity, evaluated in pending:
+                    entity_id = entity if isinstance(entity, str) else entity.id
+                    shards[entity_worker(entity_id, processor)].append((entity, pbar_update, concurrent, evaluated))
 
-            # tasks = [asyncio.ensure_future(self.process_loop(item)) for item in items]
-            [await result for result in asyncio.as_completed(tasks)]
+                pool = get_worker_pool(processor)
+                await asyncio.gather(*[pool.submit(index, self.process_shard, shard)
+                                       for index, shard in enumerate(shards) if shard])
+
+            # buffers of the workers are flushed with their shards, flush the ones of this process
+            from findy.database.buffer import flush_write_buffers
+            flush_write_buffers()
 
             await self.on_finish(entities)
 
 
 class TimeSeriesDataRecorder(RecorderForEntities):
+    # push the records into the per table write buffer instead of writing them per entity
+    write_behind = False
+    # loading into an empty table, without secondary indexes
+    backfill = False
+    # entity_id -> latest saved timestamp, loaded at once by pre_eval
+    latest_timestamps = None
+    # entity_id -> latest timestamp this worker wrote during backfill
+    backfill_timestamps = None
+
     def __init__(self,
                  entity_type: EntityType = EntityType.Stock,
                  entity_ids=None,
@@ -252,6 +327,7 @@ class TimeSeriesDataRecorder(RecorderForEntities):
         self.fix_duplicate_way = fix_duplicate_way
         self.start_timestamp = to_pd_timestamp(start_timestamp)
         self.end_timestamp = to_pd_timestamp(end_timestamp)
+        self.backfill_timestamps = {}
 
         super().__init__(entity_type, entity_ids, codes, batch_size,
                          force_update, sleep_time, share_para=share_para)
@@ -266,6 +342,32 @@ class TimeSeriesDataRecorder(RecorderForEntities):
         time_field = self.get_evaluated_time_field()
         return entity.id + '_' + df[time_field].dt.strftime(time_fmt)
 
+    def get_latest_timestamp(self, entity, db_session):
+        if self.latest_timestamps is not None:
+            return self.latest_timestamps.get(entity.entity_id)
+        return get_latest_timestamp(db_session, self.data_schema.__tablename__, entity.entity_id)
+
+    async def pre_eval(self, entities, db_session):
+        # table was empty when backfill began, nothing to look up
+        if self.backfill:
+            self.latest_timestamps = {}
+        else:
+            try:
+                self.latest_timestamps = get_latest_timestamps(db_session, self.data_schema.__tablename__)
+            except Exception as e:
+                self.logger.warning(f'get latest timestamps failed with error: {e}')
+                return await super().pre_eval(entities, db_session)
+
+        try:
+            evaluated = []
+            for entity in entities:
+                start, end, size, timestamps = await self.eval_fetch_timestamps(entity, None, db_session)
+                evaluated.append((entity, (size == 0, (start, end, size, timestamps))))
+            return evaluated
+        finally:
+            # workers look up the saved records again once they wrote new ones
+            self.latest_timestamps = None
+
     async def get_referenced_saved_record(self, entity, db_session):
         data, column_names = self.data_schema.query_data(
             region=self.region,
@@ -277,20 +379,16 @@ class TimeSeriesDataRecorder(RecorderForEntities):
 
     async def eval_fetch_timestamps(self, entity, http_session, db_session):
 
-        time_field = self.get_evaluated_time_field()
-        try:
-            time_column = eval(f'self.data_schema.{time_field}')
-            latest_records, column_names = self.data_schema.query_data(
-                region=self.region,
-                provider=self.provider,
-                db_session=db_session,
-                entity_id=entity.entity_id,
-                order=time_column.desc(),
-                limit=1000)
-            latest_timestamp = latest_records[0].timestamp if latest_records and len(latest_records) > 0 else None
-        except Exception as e:
-            self.logger.warning("get ref_record failed with error: {}".format(e))
-            latest_timestamp = None
+        latest_timestamp = None
+
+        # table was empty when backfill began, only the records written since are there
+        if self.backfill:
+            latest_timestamp = self.backfill_timestamps.get(entity.id)
+        else:
+            try:
+                latest_timestamp = self.get_latest_timestamp(entity, db_session)
+            except Exception as e:
+                self.logger.warning("get ref_record failed with error: {}".format(e))
 
         if not latest_timestamp:
             latest_timestamp = entity.timestamp
@@ -335,7 +433,17 @@ class TimeSeriesDataRecorder(RecorderForEntities):
         saved_counts = 0
         is_finished = False
 
-        if pd_valid(df_record):
+        if pd_valid(df_record) and self.write_behind:
+            assert 'id' in df_record.columns
+            from findy.database.buffer import get_write_buffer
+
+            write_buffer = get_write_buffer(region=self.region,
+                                            provider=self.provider,
+                                            data_schema=self.data_schema,
+                                            copy_format=findy_config.get('copy_format', 'csv'))
+            saved_counts = write_buffer.push(df_record)
+
+        elif pd_valid(df_record):
             assert 'id' in df_record.columns
             from findy.database.persist import df_to_db
 
@@ -345,7 +453,10 @@ class TimeSeriesDataRecorder(RecorderForEntities):
                                           db_session=db_session,
                                           df=df_record,
                                           ref_entity=entity,
-                                          fix_duplicate_way=self.fix_duplicate_way)
+                                          fix_duplicate_way=self.fix_duplicate_way,
+                                          # entity_id index is rebuilt after backfill, lookup by primary key
+                                          dedup_mode='ids' if self.backfill else 'window',
+                                          copy_format=findy_config.get('copy_format', 'csv'))
             if saved_counts == 0:
                 is_finished = True
 
@@ -353,6 +464,11 @@ class TimeSeriesDataRecorder(RecorderForEntities):
         else:
             is_finished = True
 
+        if pd_valid(df_record) and self.backfill:
+            written = df_record['timestamp'].max()
+            latest = self.backfill_timestamps.get(entity.id)
+            self.backfill_timestamps[entity.id] = written if latest is None else max(latest, written)
+
         if isinstance(self, KDataRecorder):
             is_finished = True
 
@@ -375,7 +491,17 @@ class TimeSeriesDataRecorder(RecorderForEntities):
             self.trade_day = []
             self.logger.warning("load trade days failed")
 
-        return await super().run()
+        prepare_watermarks(self.region, self.data_schema)
+
+        from findy.database.backfill import prepare_backfill, end_backfill
+        self.backfill = prepare_backfill(self.region, self.data_schema)
+
+        result = await super().run()
+
+        if self.backfill:
+            end_backfill(self.region, self.data_schema)
+
+        return result
 
 
 class KDataRecorder(TimeSeriesDataRecorder):
@@ -398,6 +524,8 @@ class KDataRecorder(TimeSeriesDataRecorder):
                          share_para=share_para)
         self.level = IntervalLevel(level)
         self.default_size = findy_config['batch_size']
+        # kdata is recorded in one batch per entity, so it could be written behind
+        self.write_behind = findy_config.get('write_buffer_rows', 0) > 0
 
     @staticmethod
     def get_kdata_schema(entity_type: EntityType,
@@ -445,20 +573,16 @@ class KDataRecorder(TimeSeriesDataRecorder):
                        one_day_trading_seconds / level.to_second())
 
     async def eval_fetch_timestamps(self, entity, http_session, db_session):
-        time_field = self.get_evaluated_time_field()
-        try:
-            time_column = eval(f'self.data_schema.{time_field}')
-            latest_records, column_names = self.data_schema.query_data(
-                region=self.region,
-                provider=self.provider,
-                db_session=db_session,
-                entity_id=entity.entity_id,
-                order=time_column.desc(),
-                limit=1000)
-            latest_timestamp = latest_records[0].timestamp if latest_records and len(latest_records) > 0 else None
-        except Exception as e:
-            self.logger.warning(f'get ref record failed with error: {e}')
-            latest_timestamp = None
+        latest_timestamp = None
+
+        # table was empty when backfill began, only the records written since are there
+        if self.backfill:
+            latest_timestamp = self.backfill_timestamps.get(entity.id)
+        else:
+            try:
+                latest_timestamp = self.get_latest_timestamp(entity, db_session)
+            except Exception as e:
+                self.logger.warning(f'get ref record failed with error: {e}')
 
         if not latest_timestamp:
             latest_timestamp = entity.timestamp
@@ -514,6 +638,10 @@ class TimestampsDataRecorder(TimeSeriesDataRecorder):
                          share_para=share_para)
         self.security_timestamps_map = {}
 
+    async def pre_eval(self, entities, db_session):
+        # the timestamps to record are fetched by http, leave them to the workers
+        return [(entity, None) for entity in entities]
+
     def init_timestamps(self, entity_item, http_session) -> List[pd.Timestamp]:
         raise NotImplementedError
 
@@ -534,20 +662,16 @@ class TimestampsDataRecorder(TimeSeriesDataRecorder):
 
         timestamps.sort()
 
-        time_field = self.get_evaluated_time_field()
-        try:
-            time_column = eval(f'self.data_schema.{time_field}')
-            latest_records, column_names = self.data_schema.query_data(
-                region=self.region,
-                provider=self.provider,
-                db_session=db_session,
-                entity_id=entity.entity_id,
-                order=time_column.desc(),
-                limit=1000)
-            latest_timestamp = latest_records[0].timestamp if latest_records and len(latest_records) > 0 else None
-        except Exception as e:
-            self.logger.warning(f'get ref_record failed with error: {e}')
-            latest_timestamp = None
+        latest_timestamp = None
+
+        # table was empty when backfill began, only the records written since are there
+        if self.backfill:
+            latest_timestamp = self.backfill_timestamps.get(entity.id)
+        else:
+            try:
+                latest_timestamp = self.get_latest_timestamp(entity, db_session)
+            except Exception as e:
+                self.logger.warning(f'get ref_record failed with error: {e}')
 
         if latest_timestamp is not None and isinstance(latest_timestamp, pd.Timestamp):
             timestamps = [t for t in timestamps if t >= latest_timestamp]
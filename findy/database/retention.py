@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.ext.declarative import DeclarativeMeta
+
+from findy import findy_config
+from findy.interface import Region
+from findy.database.context import get_db_engine
+from findy.database.partition import partition_interval, partition_bounds, get_partitions, forget_partitions
+from findy.database.query_cache import bump_generation
+from findy.database.watermark import has_watermark, rebuild_watermarks
+from findy.utils.time import now_pd_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def retention_period(tablename: str):
+    """
+    how long the rows of a table are kept, None to keep forever
+
+    retention maps a table name or a kdata level to a pandas timedelta string,
+    e.g. {"1m": "90D", "5m": "730D", "stock_1m_hfq_kdata": "30D"}, table names take precedence
+    """
+    policies = findy_config.get('retention', {})
+
+    period = policies.get(tablename)
+    if period is None:
+        parts = tablename.split('_')
+        if len(parts) >= 3 and parts[-1] == 'kdata':
+            period = policies.get(parts[1])
+
+    return pd.Timedelta(period) if period is not None else None
+
+
+def relation_size(connection, name: str) -> int:
+    return connection.execute(text("select coalesce(pg_total_relation_size(to_regclass(:t)), 0)"),
+                              {'t': name}).scalar()
+
+
+def delete_before(connection, tablename: str, cutoff, batch_size: int) -> (int, int):
+    """
+    delete the rows older than cutoff in bounded batches, each batch commits on its own
+    so locks and WAL stay small, returns (deleted rows, estimated bytes)
+    """
+    size = relation_size(connection, tablename)
+    rows = connection.execute(text("select greatest(reltuples, 0) from pg_class where oid = to_regclass(:t)"),
+                              {'t': tablename}).scalar() or 0
+
+    deleted = 0
+    while True:
+        result = connection.execute(text(
+            f"delete from {tablename} where ctid = any(array("
+            f"select ctid from {tablename} where timestamp < :cutoff limit :limit))"),
+            {'cutoff': cutoff, 'limit': batch_size})
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            break
+
+    # deleted space is reusable after vacuum, estimate it from the average row size
+    reclaimed = int(size * deleted / rows) if rows > 0 else 0
+    return deleted, reclaimed
+
+
+def apply_retention(region: Region, data_schema: DeclarativeMeta, now: pd.Timestamp = None) -> int:
+    """
+    age out the rows of data_schema older than its retention period,
+    whole partitions are dropped, the rest are deleted in batches, returns the reclaimed bytes
+    """
+    table = data_schema.__table__
+    tablename = table.name
+
+    period = retention_period(tablename)
+    if period is None:
+        return 0
+
+    cutoff = (now if now is not None else now_pd_timestamp(region)) - period
+    batch_size = findy_config.get('retention_batch_size', 10000)
+
+    engine = get_db_engine(region)
+    interval = partition_interval(tablename)
+    partitions = get_partitions(engine, tablename) if interval is not None else None
+
+    dropped = 0
+    deleted = 0
+    reclaimed = 0
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.execute(text("select to_regclass(:t)"), {'t': tablename}).scalar() is None:
+            return 0
+
+        # ctid is unique within one partition only, so the batched delete runs on the partitions
+        targets = [tablename]
+        if partitions:
+            targets = []
+            for name in sorted(partitions):
+                bounds = partition_bounds(interval, tablename, name)
+                if bounds is None or bounds[0] >= cutoff:
+                    continue
+                if bounds[1] <= cutoff:
+                    reclaimed += relation_size(connection, name)
+                    connection.execute(text(f"drop table if exists {name}"))
+                    dropped += 1
+                else:
+                    targets.append(name)
+
+            if dropped > 0:
+                forget_partitions(engine, tablename)
+
+        # rows before the cutoff in the partition it falls into, or in the whole plain table
+        for target in targets:
+            rows, size = delete_before(connection, target, cutoff, batch_size)
+            deleted += rows
+            reclaimed += size
+
+    if dropped > 0 or deleted > 0:
+        if has_watermark(table.columns.keys()):
+            rebuild_watermarks(region, tablename)
+        bump_generation(region, tablename)
+
+    logger.info(f'retention on table: [ {tablename} ], cutoff: {cutoff}, dropped partitions: {dropped}, '
+                f'deleted rows: {deleted}, reclaimed: {reclaimed / 1024 / 1024:.2f} MB')
+
+    return reclaimed
+
+
+def apply_retentions(region: Region) -> int:
+    """
+    apply the retention policies to all the registered schemas of region, returns the reclaimed bytes
+    """
+    from findy.database.schema.register import get_schemas
+
+    reclaimed = 0
+    tablenames = set()
+    for data_schema in get_schemas(region):
+        # schemas are registered once per provider
+        if data_schema.__tablename__ in tablenames or retention_period(data_schema.__tablename__) is None:
+            continue
+        tablenames.add(data_schema.__tablename__)
+
+        try:
+            reclaimed += apply_retention(region, data_schema)
+        except Exception as e:
+            logger.error(f'retention on table: [ {data_schema.__tablename__} ] failed, {e}')
+
+    logger.info(f'retention on {region.value}, reclaimed: {reclaimed / 1024 / 1024:.2f} MB')
+    return reclaimed
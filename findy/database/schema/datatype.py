@@ -5,9 +5,11 @@ from typing import List, Union
 
 import pandas as pd
 from sqlalchemy import Column, Float, String, Boolean, DateTime
+from sqlalchemy.ext.declarative import declared_attr
 
 from findy.interface import Region, Provider
 from findy.database.schema import IntervalLevel
+from findy.database.partition import partition_interval
 from findy.utils.time import to_pd_datetime, is_same_time, now_pd_timestamp
 
 
@@ -87,7 +89,8 @@ class Mixin(object):
             limit: int = None,
             index: Union[str, list] = None,
             time_field: str = 'timestamp',
-            func=None):
+            func=None,
+            return_type: str = None):
         from findy.database.query import get_data
         return get_data(
             region=region, provider=provider, data_schema=cls, db_session=db_session,
@@ -95,7 +98,59 @@ class Mixin(object):
             code=code, level=level, columns=columns, col_label=col_label,
             start_timestamp=start_timestamp, end_timestamp=end_timestamp,
             filters=filters, order=order, limit=limit, index=index,
-            time_field=time_field, fun=func)
+            time_field=time_field, fun=func, return_type=return_type)
+
+    @classmethod
+    def query_window_data(
+            cls,
+            region: Region,
+            provider: Provider,
+            db_session,
+            window: int,
+            entity_ids: List[str] = None,
+            columns: List = None,
+            start_timestamp: Union[pd.Timestamp, str] = None,
+            end_timestamp: Union[pd.Timestamp, str] = None,
+            filters: List = None,
+            index: Union[str, list] = None,
+            time_field: str = 'timestamp'):
+        from findy.database.query import get_window_data
+        return get_window_data(
+            region=region, provider=provider, data_schema=cls, db_session=db_session,
+            window=window, entity_ids=entity_ids, columns=columns,
+            start_timestamp=start_timestamp, end_timestamp=end_timestamp,
+            filters=filters, index=index, time_field=time_field)
+
+    @classmethod
+    def query_data_iter(
+            cls,
+            region: Region,
+            provider: Provider,
+            db_session,
+            ids: List[str] = None,
+            entity_ids: List[str] = None,
+            entity_id: str = None,
+            codes: List[str] = None,
+            code: str = None,
+            level: Union[IntervalLevel, str] = None,
+            columns: List = None,
+            col_label: dict = None,
+            start_timestamp: Union[pd.Timestamp, str] = None,
+            end_timestamp: Union[pd.Timestamp, str] = None,
+            filters: List = None,
+            order=None,
+            limit: int = None,
+            index: Union[str, list] = None,
+            time_field: str = 'timestamp',
+            chunk_size: int = None):
+        from findy.database.query import get_data_iter
+        return get_data_iter(
+            region=region, provider=provider, data_schema=cls, db_session=db_session,
+            ids=ids, entity_ids=entity_ids, entity_id=entity_id, codes=codes,
+            code=code, level=level, columns=columns, col_label=col_label,
+            start_timestamp=start_timestamp, end_timestamp=end_timestamp,
+            filters=filters, order=order, limit=limit, index=index,
+            time_field=time_field, chunk_size=chunk_size)
 
     @classmethod
     async def record_data(cls,
@@ -299,19 +354,17 @@ class Portfolio(EntityMixin):
         schema_str = f'{cls.__name__}Stock'
         portfolio_stock = get_schema_by_name(schema_str)
         db_session = get_db_session(region, provider, data_schema=portfolio_stock)
-        data, column_names = portfolio_stock.query_data(
+        df, column_names = portfolio_stock.query_data(
             region=region,
             provider=provider,
             db_session=db_session,
             code=code,
             codes=codes,
             timestamp=timestamp,
-            ids=ids)
+            ids=ids,
+            return_type='df')
 
-        if data and len(data) > 0:
-            return pd.DataFrame([s.__dict__ for s in data], columns=column_names)
-        else:
-            return pd.DataFrame()
+        return df if df is not None else pd.DataFrame()
 
 
 # 组合(Fund,Etf,Index,Block等)和个股(Stock)的关系 应该继承自该类
@@ -369,6 +422,19 @@ class KdataCommon(Mixin):
     # 成交金额
     turnover = Column(Float)
 
+    # intraday tables configured in kdata_partitions are range partitioned on timestamp,
+    # postgresql requires the partition key to be part of the primary key,
+    # tables created before they were configured are migrated by partition.partition_table
+    @declared_attr
+    def timestamp(cls):
+        return Column(DateTime, primary_key=partition_interval(cls.__tablename__) is not None)
+
+    @declared_attr
+    def __table_args__(cls):
+        if partition_interval(cls.__tablename__) is not None:
+            return {'postgresql_partition_by': 'RANGE (timestamp)'}
+        return {}
+
 
 class TickCommon(Mixin):
     provider = Column(String(length=32))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from sqlalchemy import Column, String, DateTime, BigInteger
+from sqlalchemy.ext.declarative import declarative_base
+
+QuarantineBase = declarative_base()
+
+
+# rows rejected by COPY, kept for inspection and replay
+class CopyQuarantine(QuarantineBase):
+    __tablename__ = 'copy_quarantine'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    # target table of the rejected row
+    table_name = Column(String(length=128))
+    # id column of the rejected row
+    row_id = Column(String)
+    # the rejected row in json
+    row = Column(String)
+    error = Column(String)
+    timestamp = Column(DateTime)
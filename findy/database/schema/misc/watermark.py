@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from sqlalchemy import Column, String, DateTime, BigInteger
+from sqlalchemy.ext.declarative import declarative_base
+
+WatermarkBase = declarative_base()
+
+
+# time range and row counts of the saved records of every entity in a table, maintained on write
+class DataWatermark(WatermarkBase):
+    __tablename__ = 'data_watermark'
+
+    table_name = Column(String(length=128), primary_key=True)
+    entity_id = Column(String(length=128), primary_key=True)
+
+    min_ts = Column(DateTime)
+    max_ts = Column(DateTime)
+    row_count = Column(BigInteger)
+    updated_at = Column(DateTime)
@@ -77,6 +77,12 @@ def register_schema(region: Region,
     __dbname_map_base[db_name] = schema_base
 
 
+def get_schemas(region: Region = None) -> list:
+    if region is None:
+        return __schemas
+    return [schema for schema in __schemas if region in getattr(schema, 'providers', {})]
+
+
 def get_schema_by_name(name: str) -> DeclarativeMeta:
     for schema in __schemas:
         if schema.__name__ == name:
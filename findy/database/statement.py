@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import logging
+from functools import lru_cache
+
+from sqlalchemy import select, bindparam
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_schema_column(data_schema, name: str):
+    """
+    the mapped column attribute name of data_schema, resolved once per schema
+    """
+    column = getattr(data_schema, name, None)
+    if column is None:
+        raise AttributeError(f'{data_schema.__name__} has no column: {name}')
+    return column
+
+
+def get_schema_columns_of(data_schema, names) -> list:
+    return [get_schema_column(data_schema, name) if isinstance(name, str) else name for name in names]
+
+
+@lru_cache(maxsize=1024)
+def select_statement(data_schema,
+                     columns: tuple = None,
+                     by: str = None,
+                     start: bool = False,
+                     end: bool = False,
+                     order: str = None,
+                     limit: bool = False,
+                     time_field: str = 'timestamp'):
+    """
+    the select of a common query shape, built once and run with bound parameters,
+    so neither the statement nor its compiled form is rebuilt per entity
+
+    :param columns: column names, None for the whole rows
+    :param by: None, 'entity_id', 'entity_ids', 'code', 'codes' or 'ids', bound as the parameter of the same name
+    :param start: bind start_timestamp as the lower bound of time_field
+    :param end: bind end_timestamp as the upper bound of time_field
+    :param order: None, 'asc' or 'desc' on time_field
+    :param limit: bind limit
+    """
+    if columns:
+        statement = select(*get_schema_columns_of(data_schema, columns))
+    else:
+        statement = select(data_schema)
+
+    if by in ('entity_id', 'code'):
+        statement = statement.where(get_schema_column(data_schema, by) == bindparam(by))
+    elif by in ('entity_ids', 'codes', 'ids'):
+        column = get_schema_column(data_schema, 'id' if by == 'ids' else by[:-1])
+        statement = statement.where(column.in_(bindparam(by, expanding=True)))
+    elif by is not None:
+        raise ValueError(f'unknown statement key: {by}')
+
+    time_col = get_schema_column(data_schema, time_field)
+    if start:
+        statement = statement.where(time_col >= bindparam('start_timestamp'))
+    if end:
+        statement = statement.where(time_col <= bindparam('end_timestamp'))
+
+    if order == 'desc':
+        statement = statement.order_by(time_col.desc())
+    elif order == 'asc':
+        statement = statement.order_by(time_col)
+
+    if limit:
+        statement = statement.limit(bindparam('limit'))
+
+    return statement
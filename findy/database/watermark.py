@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.ext.declarative import DeclarativeMeta
+
+from findy.interface import Region
+from findy.database.context import get_db_engine
+from findy.database.schema.misc.watermark import WatermarkBase, DataWatermark
+from findy.utils.time import PRECISION_STR
+
+logger = logging.getLogger(__name__)
+
+# regions with the watermark table created
+__watermark_regions = set()
+
+upsert_sql = (f"insert into {DataWatermark.__tablename__} "
+              "(table_name, entity_id, min_ts, max_ts, row_count, updated_at) {values} "
+              "on conflict (table_name, entity_id) do update set "
+              f"min_ts = least({DataWatermark.__tablename__}.min_ts, excluded.min_ts), "
+              f"max_ts = greatest({DataWatermark.__tablename__}.max_ts, excluded.max_ts), "
+              f"row_count = {DataWatermark.__tablename__}.row_count + excluded.row_count, "
+              "updated_at = excluded.updated_at")
+
+latest_sql = text(f"select max_ts from {DataWatermark.__tablename__} where table_name = :t and entity_id = :e")
+latests_sql = text(f"select entity_id, max_ts from {DataWatermark.__tablename__} where table_name = :t")
+
+
+def has_watermark(columns) -> bool:
+    return 'entity_id' in columns and 'timestamp' in columns
+
+
+def ensure_watermark_table(region: Region):
+    if region not in __watermark_regions:
+        WatermarkBase.metadata.create_all(get_db_engine(region), checkfirst=True)
+        __watermark_regions.add(region)
+
+
+def update_watermarks(region: Region, cursor, tablename: str, df: pd.DataFrame):
+    """
+    merge the time range and counts of the rows in df into the watermarks, in the transaction of cursor
+    """
+    if not has_watermark(df.columns) or len(df) == 0:
+        return
+
+    ensure_watermark_table(region)
+
+    grouped = pd.to_datetime(df['timestamp']).groupby(df['entity_id'].values)
+    stats = pd.DataFrame({'min_ts': grouped.min(), 'max_ts': grouped.max(), 'row_count': grouped.size()})
+
+    now = pd.Timestamp.now()
+    # same lock order in every writer
+    values = [(tablename, entity_id,
+               row.min_ts.to_pydatetime() if pd.notna(row.min_ts) else None,
+               row.max_ts.to_pydatetime() if pd.notna(row.max_ts) else None,
+               int(row.row_count), now)
+              for entity_id, row in stats.sort_index().iterrows()]
+
+    cursor.executemany(upsert_sql.format(values='values (%s, %s, %s, %s, %s, %s)'), values)
+
+
+def returning_watermarks_sql(tablename: str, insert_sql: str) -> str:
+    """
+    wrap insert_sql ... on conflict so the rows it inserts are merged into the watermarks
+    in the same statement, the statement returns the inserted and updated counts
+    """
+    # xmax is 0 for the inserted rows, only they are counted
+    marks = upsert_sql.format(values=f"select '{tablename}', entity_id, min(timestamp), max(timestamp), "
+                                     "count(*) filter (where inserted), now() from saved "
+                                     "group by entity_id order by entity_id")
+    return (f"with saved as ({insert_sql} returning entity_id, timestamp, (xmax = 0) as inserted), "
+            f"marks as ({marks}) "
+            "select count(*) from saved")
+
+
+def discount_watermarks(db_session, tablename: str, entity_ids: list):
+    """
+    take the deleted rows of entity_ids out of the row counts, the time range is kept
+    since the deleted rows are written back right after
+    """
+    if not entity_ids:
+        return
+
+    counts = pd.Series(entity_ids).value_counts().sort_index()
+    db_session.execute(
+        text(f"update {DataWatermark.__tablename__} set row_count = greatest(row_count - :count, 0) "
+             "where table_name = :t and entity_id = :e"),
+        [{'t': tablename, 'e': entity_id, 'count': int(count)} for entity_id, count in counts.items()])
+
+
+def rebuild_watermarks(region: Region, tablename: str):
+    """
+    recompute the watermarks of tablename from the table itself, it scans the whole table,
+    used to initialize the watermarks of a loaded table, and after retention removed old rows
+    """
+    now = time.time()
+    ensure_watermark_table(region)
+
+    with get_db_engine(region).begin() as connection:
+        connection.execute(text(f"delete from {DataWatermark.__tablename__} where table_name = :t"),
+                           {'t': tablename})
+        result = connection.execute(text(
+            f"insert into {DataWatermark.__tablename__} "
+            "(table_name, entity_id, min_ts, max_ts, row_count, updated_at) "
+            f"select :t, entity_id, min(timestamp), max(timestamp), count(*), now() from {tablename} "
+            "where entity_id is not null group by entity_id"), {'t': tablename})
+
+    cost = PRECISION_STR.format(time.time() - now)
+    logger.info(f'rebuild watermarks of table: [ {tablename} ], entities: {result.rowcount}, cost: {cost}')
+
+
+def prepare_watermarks(region: Region, data_schema: DeclarativeMeta):
+    """
+    create the watermark table, and build the watermarks of a table loaded before they were maintained
+    """
+    tablename = data_schema.__tablename__
+    if not has_watermark(data_schema.__table__.columns.keys()):
+        return
+
+    ensure_watermark_table(region)
+
+    with get_db_engine(region).connect() as connection:
+        marked = connection.execute(text(f"select 1 from {DataWatermark.__tablename__} where table_name = :t limit 1"),
+                                    {'t': tablename}).first() is not None
+        if marked:
+            return
+        empty = connection.execute(text(f"select 1 from {tablename} limit 1")).first() is None
+
+    if not empty:
+        rebuild_watermarks(region, tablename)
+
+
+def get_latest_timestamp(db_session, tablename: str, entity_id: str):
+    """
+    timestamp of the latest saved record of entity_id, None if nothing saved
+    """
+    latest = db_session.execute(latest_sql, {'t': tablename, 'e': entity_id}).scalar()
+    return pd.Timestamp(latest) if latest is not None else None
+
+
+def get_latest_timestamps(db_session, tablename: str) -> dict:
+    """
+    entity_id -> timestamp of the latest saved record, of all the entities of tablename in one query
+    """
+    rows = db_session.execute(latests_sql, {'t': tablename}).fetchall()
+    return {entity_id: pd.Timestamp(latest) for entity_id, latest in rows if latest is not None}
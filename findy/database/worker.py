@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# processes -> WorkerPool started by this process
+__worker_pools = {}
+
+
+def entity_worker(entity_id: str, workers: int) -> int:
+    """
+    the worker an entity is always dispatched to, so the per worker caches of it stay warm
+    """
+    return zlib.crc32(entity_id.encode('utf-8')) % workers
+
+
+async def run_job(job, results):
+    job_id, corofn, args = job
+    try:
+        results.put((job_id, await corofn(*args), None))
+    except Exception:
+        results.put((job_id, None, traceback.format_exc()))
+
+
+async def serve(jobs, results):
+    """
+    run the jobs concurrently until the None sentinel, then wait for the ones still running
+    """
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    # the queue is read on a thread of its own, the running jobs go on meanwhile
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='worker_jobs') as reader:
+        while True:
+            job = await loop.run_in_executor(reader, jobs.get)
+            if job is None:
+                break
+
+            task = loop.create_task(run_job(job, results))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    if running:
+        await asyncio.wait(running)
+
+
+def worker_main(jobs, results):
+    """
+    run the jobs of one worker on a single event loop until the None sentinel
+    """
+    from findy.database.context import reset_db_context
+    from findy.utils.request import close_worker_http_session
+
+    # engines forked from the parent share its sockets
+    reset_db_context()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(jobs, results))
+    finally:
+        loop.run_until_complete(close_worker_http_session())
+        loop.close()
+
+
+def resolve(future: asyncio.Future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(RuntimeError(error))
+    else:
+        future.set_result(result)
+
+
+def notify(loop, future: asyncio.Future, result, error):
+    # the submitter may have given up on the job and closed its loop
+    if not loop.is_closed():
+        try:
+            loop.call_soon_threadsafe(resolve, future, result, error)
+        except RuntimeError:
+            pass
+
+
+class WorkerPool(object):
+    """
+    long lived worker processes, each runs one event loop and takes jobs from a queue of its own,
+    the jobs of a worker run concurrently on its loop, so the tasks sharing the pool do not queue
+    behind each other
+
+    a job is a coroutine function and its arguments, it must be picklable, its result is
+    resolved on the asyncio future returned by submit, in the loop which submitted it
+    """
+
+    def __init__(self, processes: int) -> None:
+        self.processes = processes
+        self.jobs = [multiprocessing.Queue() for _ in range(processes)]
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=worker_main, args=(jobs, self.results), daemon=True)
+                        for jobs in self.jobs]
+        for worker in self.workers:
+            worker.start()
+
+        self.job_ids = itertools.count()
+        # job_id -> (worker index, loop, future)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def is_alive(self) -> bool:
+        return not self.closed and all(worker.is_alive() for worker in self.workers)
+
+    def submit(self, index: int, corofn, *args) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        job_id = next(self.job_ids)
+        with self.lock:
+            self.pending[job_id] = (index, loop, future)
+        self.jobs[index].put((job_id, corofn, args))
+        return future
+
+    def collect(self):
+        while not self.closed:
+            try:
+                job_id, result, error = self.results.get(timeout=1)
+            except queue.Empty:
+                self.fail_dead()
+                continue
+
+            with self.lock:
+                _, loop, future = self.pending.pop(job_id, (None, None, None))
+            if future is not None:
+                notify(loop, future, result, error)
+
+    def fail_dead(self):
+        """
+        fail the jobs of the workers which exited, their results never come
+        """
+        dead = set(index for index, worker in enumerate(self.workers) if not worker.is_alive())
+        if not dead:
+            return
+
+        with self.lock:
+            failed = [(job_id, loop, future) for job_id, (index, loop, future) in self.pending.items() if index in dead]
+            for job_id, _, _ in failed:
+                del self.pending[job_id]
+
+        for job_id, loop, future in failed:
+            notify(loop, future, None, f'worker of job {job_id} exited')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        for jobs, worker in zip(self.jobs, self.workers):
+            if worker.is_alive():
+                jobs.put(None)
+        for worker in self.workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def get_worker_pool(processes: int) -> WorkerPool:
+    """
+    the worker pool of processes workers, started on first use and kept until this process exits
+    """
+    pool = __worker_pools.get(processes)
+    if pool is None or not pool.is_alive():
+        if pool is not None:
+            logger.warning(f'worker pool of {processes} processes lost a worker, restart it')
+            pool.close()
+
+        pool = WorkerPool(processes)
+        if not __worker_pools:
+            atexit.register(close_worker_pools)
+        __worker_pools[processes] = pool
+    return pool
+
+
+def close_worker_pools():
+    for pool in __worker_pools.values():
+        pool.close()
+    __worker_pools.clear()
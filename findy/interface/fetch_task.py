@@ -1,9 +1,11 @@
 import warnings
 warnings.filterwarnings("ignore")
 
+import asyncio
 import logging
 import os
 
+from findy import findy_config
 from findy.interface import Region, Provider
 from findy.task import RunMode
 from findy.extra.esg.esg_keyword import esg_news_key, esg_companys_key
@@ -149,6 +151,12 @@ class task():
         from findy.database.schema.quotes.stock.stock_1d_kdata import Stock1dKdata
         await Stock1dKdata.record_data(args[0], args[1], sleep_time=args[2], share_para=args[3:])
 
+        from findy.database.panel_store import update_panel_stores
+        await asyncio.get_event_loop().run_in_executor(None, update_panel_stores, args[0], Stock1dKdata.__tablename__)
+
+        from findy.database.mirror import sync_mirrors
+        await asyncio.get_event_loop().run_in_executor(None, sync_mirrors, args[0], Stock1dKdata.__tablename__)
+
     @staticmethod
     async def get_stock_1d_hfq_k_data(args):
         # 日线复权
@@ -249,6 +257,18 @@ class task():
         from findy.database.schema.quotes.index.index_1d_kdata import Index1dKdata
         await Index1dKdata.record_data(args[0], args[1], sleep_time=args[2], share_para=args[3:])
 
+        from findy.database.panel_store import update_panel_stores
+        await asyncio.get_event_loop().run_in_executor(None, update_panel_stores, args[0], Index1dKdata.__tablename__)
+
+        from findy.database.mirror import sync_mirrors
+        await asyncio.get_event_loop().run_in_executor(None, sync_mirrors, args[0], Index1dKdata.__tablename__)
+
+    @staticmethod
+    async def apply_retention(args):
+        # 过期数据清理
+        from findy.database.retention import apply_retentions
+        await asyncio.get_event_loop().run_in_executor(None, apply_retentions, args[0])
+
     @staticmethod
     async def get_news_title(args):
         from findy.database.schema.meta.news_meta import NewsTitle
@@ -312,6 +332,11 @@ task_stock_chn = [
 #   ["chn_stock_tick", "task_039", RunMode.Parallel, 24,      task.get_stock_1m_hfq_k_data,          [Region.CHN, Provider.BaoStock,  0, os.cpu_count(), 10, "Stock 1 mins HFQ K-Data"]],
 ]
 
+# retention deletes history, it is scheduled only if policies are configured
+if findy_config.get('retention'):
+    task_stock_chn.append(
+    ["chn_stock_tick", "task_040", RunMode.Serial,   24,      task.apply_retention,                  [Region.CHN, Provider.BaoStock,  0, os.cpu_count(),  1, "Retention"]])
+
 
 task_news_chn = [
     # ["chn_news",      "task_001", RunMode.Parallel,  24,      task.get_news_title,                   [Region.CHN, Provider.EastMoney, 0, os.cpu_count(), 10, "News Title"]],
@@ -336,6 +361,10 @@ task_stock_us = [
     ["us_stock_tick", "task_013", RunMode.Parallel,  24 * 6,  task.get_stock_1m_k_data,              [Region.US,  Provider.Yahoo,     0, os.cpu_count(),  3, "Stock 1 mins K-Data"]],
 ]
 
+if findy_config.get('retention'):
+    task_stock_us.append(
+    ["us_stock_tick", "task_014", RunMode.Serial,    24,      task.apply_retention,                  [Region.US,  Provider.Yahoo,     0, os.cpu_count(),  1, "Retention"]])
+
 
 ESG_keywords = esg_news_key()
 ESG_companylist = esg_companys_key()
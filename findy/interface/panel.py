@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+class Panel(object):
+    """
+    columnar [field][entity][time] float64 values on one aligned calendar, NaN where missing
+
+    entities and fields are located by dict lookup and time by binary search, the
+    selections are views on values, so cross sections are plain numpy slices
+    """
+
+    def __init__(self, values: np.ndarray, fields: List[str], entity_ids: List[str], timestamps) -> None:
+        assert values.shape == (len(fields), len(entity_ids), len(timestamps))
+
+        self.values = values
+        self.fields = list(fields)
+        self.entity_ids = list(entity_ids)
+        self.timestamps = pd.DatetimeIndex(timestamps)
+
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+        self.entity_index = {entity_id: i for i, entity_id in enumerate(self.entity_ids)}
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, fields: List[str] = None,
+                category_field: str = 'entity_id', time_field: str = 'timestamp'):
+        """
+        pivot a long format frame, indexed or with columns (category_field, time_field),
+        fields default to all its numeric columns
+        """
+        if isinstance(df.index, pd.MultiIndex) and df.index.names[:2] == [category_field, time_field]:
+            entities = df.index.get_level_values(0)
+            times = df.index.get_level_values(1)
+        else:
+            entities = df[category_field]
+            times = df[time_field]
+
+        if fields is None:
+            fields = [col for col in df.select_dtypes(include=[np.number, np.bool_]).columns
+                      if col not in (category_field, time_field)]
+
+        entity_codes, entity_ids = pd.factorize(np.asarray(entities), sort=True)
+        time_codes, timestamps = pd.factorize(pd.DatetimeIndex(times), sort=True)
+
+        values = np.full((len(fields), len(entity_ids), len(timestamps)), np.nan)
+        for i, field in enumerate(fields):
+            values[i, entity_codes, time_codes] = df[field].to_numpy(dtype=np.float64, na_value=np.nan)
+
+        return cls(values, fields, entity_ids, timestamps)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def mask(self) -> np.ndarray:
+        """
+        [entity][time] True where the entity has a record of any field
+        """
+        return ~np.isnan(self.values).all(axis=0)
+
+    def field(self, field: str) -> np.ndarray:
+        return self.values[self.field_index[field]]
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.field(field)
+
+    def entity(self, entity_id: str) -> np.ndarray:
+        """
+        [field][time] values of entity_id
+        """
+        return self.values[:, self.entity_index[entity_id]]
+
+    def time_slice(self, start_timestamp=None, end_timestamp=None) -> slice:
+        start = self.timestamps.searchsorted(pd.Timestamp(start_timestamp)) if start_timestamp is not None else 0
+        end = self.timestamps.searchsorted(pd.Timestamp(end_timestamp), side='right') \
+            if end_timestamp is not None else len(self.timestamps)
+        return slice(start, end)
+
+    def cross_section(self, timestamp) -> np.ndarray:
+        """
+        [field][entity] values at timestamp
+        """
+        return self.values[:, :, self.timestamps.get_loc(pd.Timestamp(timestamp))]
+
+    def select(self, entity_ids: List[str] = None, fields: List[str] = None,
+               start_timestamp=None, end_timestamp=None):
+        """
+        sub panel, a view on values if only the time range is selected
+        """
+        times = self.time_slice(start_timestamp, end_timestamp)
+        values = self.values[:, :, times]
+
+        if fields is not None:
+            values = values[[self.field_index[field] for field in fields]]
+        else:
+            fields = self.fields
+
+        if entity_ids is not None:
+            entity_ids = [entity_id for entity_id in entity_ids if entity_id in self.entity_index]
+            values = values[:, [self.entity_index[entity_id] for entity_id in entity_ids]]
+        else:
+            entity_ids = self.entity_ids
+
+        return Panel(values, fields, entity_ids, self.timestamps[times])
+
+    def to_df(self, category_field: str = 'entity_id', time_field: str = 'timestamp') -> pd.DataFrame:
+        """
+        back to the long format, (category_field, time_field) indexed rows where the entity has a record
+        """
+        entity_rows, time_cols = np.nonzero(self.mask)
+        index = pd.MultiIndex.from_arrays([np.asarray(self.entity_ids, dtype=object)[entity_rows],
+                                           self.timestamps[time_cols]], names=[category_field, time_field])
+        return pd.DataFrame({field: self.values[i, entity_rows, time_cols] for i, field in enumerate(self.fields)},
+                            index=index)
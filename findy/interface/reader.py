@@ -4,6 +4,7 @@ import logging
 import time
 from typing import List, Union, Type
 
+import numpy as np
 import pandas as pd
 
 from findy.interface import Region, Provider, EntityType
@@ -14,8 +15,10 @@ from findy.database.schema.quotes.index.index_1d_kdata import Index1dKdata
 from findy.database.schema.quotes.stock.stock_1d_kdata import Stock1dKdata
 from findy.database.schema.register import get_entity_schema_by_type
 from findy.database.context import get_db_session
+from findy.database.statement import get_schema_column
+from findy.interface.panel import Panel
 from findy.database.quote import get_entities
-from findy.utils.pd import fill_missing_timestamp
+from findy.utils.pd import pd_valid, index_df, fill_missing_timestamp
 from findy.utils.time import to_pd_timestamp, now_pd_timestamp
 
 
@@ -70,7 +73,8 @@ class DataReader(object):
                  level: IntervalLevel = None,
                  category_field: str = 'entity_id',
                  time_field: str = 'timestamp',
-                 computing_window: int = None) -> None:
+                 computing_window: int = None,
+                 source: str = 'db') -> None:
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.data_schema = data_schema
@@ -117,9 +121,11 @@ class DataReader(object):
         self.category_field = category_field
         self.time_field = time_field
         self.computing_window = computing_window
+        # 'db', or 'parquet' to read the synced history from the local mirror and only the rest from db
+        self.source = source
 
-        self.category_col = eval(f'self.data_schema.{self.category_field}')
-        self.time_col = eval(f'self.data_schema.{self.time_field}')
+        self.category_col = get_schema_column(self.data_schema, self.category_field)
+        self.time_col = get_schema_column(self.data_schema, self.time_field)
 
         self.columns = columns
 
@@ -129,7 +135,7 @@ class DataReader(object):
             if type(columns[0]) == str:
                 self.columns = []
                 for col in columns:
-                    self.columns.append(eval(f'data_schema.{col}'))
+                    self.columns.append(get_schema_column(data_schema, col))
 
             # always add category_column and time_field for normalizing
             # self.columns = list(set(self.columns) | {self.category_col, self.time_col})
@@ -138,6 +144,7 @@ class DataReader(object):
         self.data_listeners: List[DataListener] = []
 
         self.data_df: pd.DataFrame = None
+        self.data_panel: Panel = None
 
         # self.load_data()
 
@@ -146,39 +153,20 @@ class DataReader(object):
 
         db_session = get_db_session(self.region, self.provider, data_schema)
 
-        dfs = []
-        for entity_id in self.entity_ids:
-            data, column_names = data_schema.query_data(
-                region=self.region,
-                provider=self.provider,
-                db_session=db_session,
-                entity_id=entity_id,
-                index=[self.category_field, self.time_field],
-                order=data_schema.timestamp.desc(),
-                limit=window)
-
-            if data and len(data) > 0:
-                df = pd.DataFrame([s.__dict__ for s in data], columns=column_names)
-                dfs.append(df)
-        if dfs:
-            window_df = pd.concat(dfs)
-            window_df = window_df.sort_index(level=[0, 1])
-        return window_df
-
-    def load_data(self):
-        self.logger.info('load_data start')
-        start_time = time.time()
-
-        db_session = get_db_session(self.region, self.provider, self.data_schema)
+        df, column_names = data_schema.query_window_data(
+            region=self.region,
+            provider=self.provider,
+            db_session=db_session,
+            window=window,
+            entity_ids=self.entity_ids,
+            index=[self.category_field, self.time_field],
+            time_field=self.time_field)
 
-        # params = dict(entity_ids=self.entity_ids, provider=self.provider,
-        #               columns=self.columns, start_timestamp=self.start_timestamp,
-        #               end_timestamp=self.end_timestamp, filters=self.filters,
-        #               order=self.order, limit=self.limit, level=self.level,
-        #               index=[self.category_field, self.time_field],
-        #               time_field=self.time_field)
-        # self.logger.info(f'query_data params:{params}')
+        if pd_valid(df):
+            window_df = df.sort_index(level=[0, 1])
+        return window_df
 
+    def init_entity_ids(self, db_session) -> bool:
         # 转换成标准entity_id
         if self.entity_schema and not self.entity_ids:
             entities, column_names = get_entities(
@@ -193,9 +181,20 @@ class DataReader(object):
             if len(entities) > 0:
                 self.entity_ids = [entity.entity_id for entity in entities]
             else:
-                return
+                return False
+        return True
+
+    def iter_data(self, chunk_size: int = None):
+        """
+        iterate the data in DataFrame chunks of chunk_size rows, for ranges too large for load_data,
+        chunks are not kept in data_df and the data listeners are not notified
+        """
+        db_session = get_db_session(self.region, self.provider, self.data_schema)
+
+        if not self.init_entity_ids(db_session):
+            return
 
-        data, column_names = self.data_schema.query_data(
+        yield from self.data_schema.query_data_iter(
             region=self.region,
             provider=self.provider,
             db_session=db_session,
@@ -208,12 +207,114 @@ class DataReader(object):
             limit=self.limit,
             level=self.level,
             index=[self.category_field, self.time_field],
-            time_field=self.time_field)
+            time_field=self.time_field,
+            chunk_size=chunk_size)
+
+    def load_mirror_df(self, db_session):
+        """
+        the mirrored rows from parquet, plus the rows saved since the last sync from db,
+        None if the mirror could not serve the query
+        """
+        from findy.database.mirror import mirror_coverage, read_mirror
+
+        # sql filters, order and limit could not be applied on parquet
+        if self.filters or self.order is not None or self.limit:
+            return None
+
+        until, missing = mirror_coverage(self.region, self.data_schema, self.entity_ids)
+        if until is None:
+            return None
+
+        columns = self.columns
+        if columns:
+            columns = list(set(columns) | {self.data_schema.id, self.category_col, self.time_col})
+
+        dfs = [read_mirror(self.region, self.data_schema,
+                           entity_ids=self.entity_ids,
+                           columns=columns,
+                           start_timestamp=self.start_timestamp,
+                           end_timestamp=self.end_timestamp)]
+
+        params = [(self.entity_ids, max(until, self.start_timestamp) if self.start_timestamp else until)]
+        if missing:
+            params.append((missing, self.start_timestamp))
+
+        for entity_ids, start_timestamp in params:
+            if self.end_timestamp and start_timestamp and start_timestamp > self.end_timestamp:
+                continue
+            df, column_names = self.data_schema.query_data(
+                region=self.region,
+                provider=self.provider,
+                db_session=db_session,
+                entity_ids=entity_ids,
+                columns=columns,
+                start_timestamp=start_timestamp,
+                end_timestamp=self.end_timestamp,
+                level=self.level,
+                time_field=self.time_field,
+                return_type='df')
+            dfs.append(df)
+
+        dfs = [df for df in dfs if pd_valid(df)]
+        if not dfs:
+            return pd.DataFrame()
+
+        # the rows at the sync watermark are read from both
+        df = pd.concat(dfs, ignore_index=True).drop_duplicates(subset='id', keep='last')
+        return index_df(df, index=[self.category_field, self.time_field], time_field=self.time_field)
+
+    def load_panel(self, fields: List[str] = None) -> Panel:
+        """
+        the loaded data as a [field][entity][time] Panel, fields default to the numeric columns
+        """
+        if self.data_df is None:
+            self.load_data()
 
-        if data and not self.columns:
-            self.data_df = pd.DataFrame([s.__dict__ for s in data], columns=column_names)
+        if pd_valid(self.data_df):
+            self.data_panel = Panel.from_df(self.data_df, fields=fields,
+                                            category_field=self.category_field, time_field=self.time_field)
         else:
-            self.data_df = pd.DataFrame(data, columns=column_names)
+            self.data_panel = None
+        return self.data_panel
+
+    def load_data(self):
+        self.logger.info('load_data start')
+        start_time = time.time()
+
+        db_session = get_db_session(self.region, self.provider, self.data_schema)
+
+        # params = dict(entity_ids=self.entity_ids, provider=self.provider,
+        #               columns=self.columns, start_timestamp=self.start_timestamp,
+        #               end_timestamp=self.end_timestamp, filters=self.filters,
+        #               order=self.order, limit=self.limit, level=self.level,
+        #               index=[self.category_field, self.time_field],
+        #               time_field=self.time_field)
+        # self.logger.info(f'query_data params:{params}')
+
+        if not self.init_entity_ids(db_session):
+            return
+
+        if self.source == 'parquet':
+            self.data_df = self.load_mirror_df(db_session)
+            if self.data_df is None:
+                self.logger.warning(f'parquet mirror of {self.data_schema.__tablename__} could not serve, read db')
+
+        if self.source != 'parquet' or self.data_df is None:
+            self.data_df, column_names = self.data_schema.query_data(
+                region=self.region,
+                provider=self.provider,
+                db_session=db_session,
+                entity_ids=self.entity_ids,
+                columns=self.columns,
+                start_timestamp=self.start_timestamp,
+                end_timestamp=self.end_timestamp,
+                filters=self.filters,
+                order=self.order,
+                limit=self.limit,
+                level=self.level,
+                index=[self.category_field, self.time_field],
+                time_field=self.time_field,
+                return_type='df')
 
         cost_time = time.time() - start_time
         self.logger.info(f'load_data finished, cost_time:{cost_time}')
@@ -222,9 +323,7 @@ class DataReader(object):
             listener.on_data_loaded(self.data_df)
 
 
-def load_ticker(tickers, start, end, return_type='mix'):
-    ticker_type = {'index': [Index1dKdata, Index],
-                   'stock': [Stock1dKdata, Stock]}
+def load_ticker_db(ticker_type, tickers, start, end):
     result_dict = {}
 
     for key, value in ticker_type.items():
@@ -261,8 +360,81 @@ def load_ticker(tickers, start, end, return_type='mix'):
         ticker_type_code[key] = value.code.unique().tolist()
         data_df_list.append(value)
 
+    if not data_df_list:
+        return None, None
+
     data_df = fill_missing_timestamp(pd.concat(data_df_list))
 
+    return data_df, ticker_type_code
+
+
+def load_ticker_panel(ticker_type, tickers, start, end):
+    """
+    (data_df, ticker_type_code) of load_ticker sliced from the us_1d panel store, the tickers
+    the store does not have are loaded from the db, (None, None) if the store is not built
+    """
+    from findy.database.panel_store import get_panel_store, panel_fields
+
+    store = get_panel_store(Region.US, 'us_1d')
+    if store is None:
+        return None, None
+
+    rows = store.code_rows(tickers)
+    missing = [] if tickers is None else sorted(set(tickers) - set(store.codes[row] for row in rows))
+    db_df, db_ticker_type_code = load_ticker_db(ticker_type, missing, start, end) if missing else (None, None)
+
+    days = store.day_slice(start, end)
+    values = np.stack([store.field(field)[rows, days] for field in panel_fields])
+
+    # keep the entities and days with records, like fill_missing_timestamp on the concatenated frames
+    present = ~np.isnan(values).all(axis=0)
+    entities = present.any(axis=1)
+    if not entities.any():
+        return db_df, db_ticker_type_code
+    rows, values, present = rows[entities], values[:, entities], present[entities]
+    observed = present.any(axis=0)
+    values, present = values[:, :, observed], present[:, observed]
+    calendar = store.calendar[days][observed]
+
+    # forward fill the days an entity has no record, zero before its first record and for missing values
+    last = np.maximum.accumulate(np.where(present, np.arange(present.shape[1]), -1), axis=1)
+    values = values[:, np.arange(len(rows))[:, None], np.maximum(last, 0)]
+    values[:, last < 0] = np.nan
+    values = np.nan_to_num(values, nan=0.0)
+
+    codes = [store.codes[row] for row in rows]
+    data_df = pd.DataFrame({'timestamp': np.tile(calendar.astype('datetime64[D]').astype('datetime64[ns]'), len(rows))})
+    for field, field_values in zip(panel_fields, values):
+        data_df[field] = field_values.ravel()
+    data_df['code'] = np.repeat(codes, len(calendar))
+
+    tables = {Index1dKdata.__tablename__: 'index', Stock1dKdata.__tablename__: 'stock'}
+    ticker_type_code = {}
+    for row, code in zip(rows, codes):
+        ticker_type_code.setdefault(tables.get(store.meta['tables'][row]), []).append(code)
+
+    # the days of the db rows are filled in the panel rows as well
+    if db_df is not None:
+        data_df = fill_missing_timestamp(pd.concat([data_df, db_df]))
+        for key, db_codes in db_ticker_type_code.items():
+            ticker_type_code.setdefault(key, []).extend(db_codes)
+
+    ticker_type_code = {key: ticker_type_code[key] for key in ['index', 'stock'] if key in ticker_type_code}
+
+    return data_df, ticker_type_code
+
+
+def load_ticker(tickers, start, end, return_type='mix'):
+    ticker_type = {'index': [Index1dKdata, Index],
+                   'stock': [Stock1dKdata, Stock]}
+    result_dict = {}
+
+    data_df, ticker_type_code = load_ticker_panel(ticker_type, tickers, start, end)
+    if data_df is None:
+        data_df, ticker_type_code = load_ticker_db(ticker_type, tickers, start, end)
+    if data_df is None:
+        return None
+
     # create day of the week column (monday = 0)
     # data_df["day"] = data_df["timestamp"].dt.dayofweek
 
@@ -290,14 +462,17 @@ def load_ticker(tickers, start, end, return_type='mix'):
 def load_company_info(tickers=None):
     entity_schema = get_entity_schema_by_type(EntityType.StockDetail)
     db_session = get_db_session(Region.US, Provider.Yahoo, entity_schema)
-    entities, column_names = get_entities(
+    df, column_names = get_entities(
         region=Region.US,
         provider=Provider.Yahoo,
         entity_schema=entity_schema,
         db_session=db_session,
-        codes=tickers)
+        codes=tickers,
+        return_type='df')
+
+    if df is None:
+        return pd.DataFrame()
 
-    df = pd.DataFrame([s.__dict__ for s in entities], columns=column_names)
     df.reset_index(drop=True, inplace=True)
 
     return df
@@ -22,12 +22,21 @@ kafka_producer = connect_kafka_producer(findy_config['kafka'])
 
 async def loop_task_set(task):
     now = time.time()
+    started = time.time_ns()
     item, index, pbar_update, schedule_cache, schedule_file = task
 
     logger.info(f"Start Func: {item[TaskArgs.FunName.value].__name__}")
     await item[TaskArgs.FunName.value](item[TaskArgs.Extend.value])
     logger.info(f"End Func: {item[TaskArgs.FunName.value].__name__}, cost: {time.time() - now}\n")
 
+    # refresh planner statistics of the tables the task wrote to, off the event loop,
+    # every committed write bumps the generation of its table
+    from findy.database.maintenance import maintain_tables
+    from findy.database.query_cache import tables_written_since
+    region = item[TaskArgs.Extend.value][TaskArgsExtend.Region.value]
+    await asyncio.get_event_loop().run_in_executor(None, maintain_tables, region,
+                                                   tables_written_since(region, started))
+
     publish_message(kafka_producer, progress_topic, progress_key,
                     msgpack.dumps({"command": "@task-finish", "task": item[TaskArgs.Extend.value][TaskArgsExtend.TaskID.value]}))
 
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import contextvars
+import fcntl
+import logging
+import mmap
+import os
+import statistics
+import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from findy import findy_config, findy_env
+from findy.interface import Provider
+
+logger = logging.getLogger(__name__)
+
+# tokens left, time of the last refill, in flight limit, throttled rate, time of the last backoff
+header = struct.Struct('ddddd')
+# pid, requests in flight of pid
+slot = struct.Struct('qq')
+max_slots = 64
+bucket_size = header.size + slot.size * max_slots
+
+# how long to wait for a request in flight to finish
+poll_interval = 0.05
+
+# the in flight limit is cut at most once per median latency, the requests in flight when
+# the provider started throttling fail together, the interval until latencies are known
+backoff_interval = 1.0
+# weight of the latest request in the throttled rate
+error_alpha = 0.05
+# successful request latencies kept per process, and the least of them to judge the percentiles by
+latency_window = 100
+latency_min_samples = 20
+
+# messages of the errors which mean the provider is throttling or overloaded
+throttle_signs = ('429', 'too many requests', 'rate limit', 'server disconnected', 'timed out', 'timeout')
+
+# the provider request running in the current task
+current_request = contextvars.ContextVar('current_request', default=None)
+
+# threads of the providers without rate_limits
+default_threads = 4
+
+# provider -> RateLimiter opened by this process
+__rate_limiters = {}
+
+# provider -> (pid, ThreadPoolExecutor) running the blocking calls of the provider
+__provider_executors = {}
+
+
+def is_throttled(error) -> bool:
+    if isinstance(error, TimeoutError):
+        return True
+    message = str(error).lower()
+    return any(sign in message for sign in throttle_signs)
+
+
+def report_throttled(error=None):
+    """
+    mark the provider request of the current task as throttled, if error is a throttling one,
+    for the sdks which catch their errors instead of raising them through the request
+    """
+    request = current_request.get()
+    if request is not None and (error is None or is_throttled(error)):
+        request.throttled = True
+
+
+class RateLimiter(object):
+    """
+    token bucket of rate requests per second up to burst, plus an adaptive limit of the requests in flight,
+    shared by all the processes of the host through a memory mapped file updated under flock
+
+    the in flight limit is AIMD controlled: it grows by one per limit successful requests up to inflight,
+    unless the 90th percentile latency of the recent requests is over latency_tolerance times the median,
+    and it is cut by backoff when the provider throttles, down to min_inflight
+
+    the requests in flight are counted per pid, so the ones of an exited process are dropped
+    """
+
+    def __init__(self,
+                 name: str,
+                 rate: float,
+                 burst: int,
+                 inflight: int,
+                 min_inflight: int = 1,
+                 backoff: float = 0.5,
+                 latency_tolerance: float = 3.0) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.inflight = max(inflight, 1)
+        self.min_inflight = min(max(min_inflight, 1), self.inflight)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latencies = deque(maxlen=latency_window)
+        self.pid = os.getpid()
+
+        path = os.path.join(findy_env['cache_path'], 'rate_limit')
+        os.makedirs(path, exist_ok=True)
+
+        # a zeroed bucket refills to burst on first use
+        self.fd = os.open(os.path.join(path, f'{name}.bucket'), os.O_RDWR | os.O_CREAT, 0o644)
+        with self.locked():
+            if os.fstat(self.fd).st_size < bucket_size:
+                os.ftruncate(self.fd, bucket_size)
+        self.map = mmap.mmap(self.fd, bucket_size)
+
+    @contextlib.contextmanager
+    def locked(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def slots(self):
+        for index in range(max_slots):
+            pid, count = slot.unpack_from(self.map, header.size + index * slot.size)
+            yield index, pid, count
+
+    def set_slot(self, index: int, pid: int, count: int):
+        slot.pack_into(self.map, header.size + index * slot.size, pid, count)
+
+    def in_flight(self) -> int:
+        """
+        the requests in flight of all the processes, the slots of exited processes are released
+        """
+        total = 0
+        for index, pid, count in self.slots():
+            if pid == 0:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                self.set_slot(index, 0, 0)
+                continue
+            except PermissionError:
+                pass
+            total += count
+        return total
+
+    def add_in_flight(self, delta: int):
+        free = None
+        for index, pid, count in self.slots():
+            if pid == self.pid:
+                self.set_slot(index, pid, max(count + delta, 0))
+                return
+            if free is None and (pid == 0 or count == 0):
+                free = index
+
+        if delta > 0 and free is not None:
+            self.set_slot(free, self.pid, delta)
+
+    def current_limit(self, limit: float) -> float:
+        # a new bucket starts half way
+        return limit if limit > 0 else max(self.min_inflight, self.inflight / 2)
+
+    def try_acquire(self) -> float:
+        """
+        take a token and an in flight slot, returns 0 if taken, the seconds to wait otherwise
+        """
+        with self.locked():
+            now = time.time()
+            tokens, last, limit, errors, backoff_at = header.unpack_from(self.map, 0)
+            tokens = min(self.burst, tokens + max(now - last, 0) * self.rate)
+            limit = self.current_limit(limit)
+
+            if self.in_flight() >= int(limit):
+                wait = poll_interval
+            elif tokens < 1:
+                wait = (1 - tokens) / self.rate
+            else:
+                tokens -= 1
+                self.add_in_flight(1)
+                wait = 0
+
+            header.pack_into(self.map, 0, tokens, now, limit, errors, backoff_at)
+            return wait
+
+    def latency_inflated(self, latency: float) -> bool:
+        self.latencies.append(latency)
+        if len(self.latencies) < latency_min_samples:
+            return False
+        deciles = statistics.quantiles(self.latencies, n=10)
+        return deciles[8] > self.latency_tolerance * deciles[4]
+
+    def round_trip(self) -> float:
+        if len(self.latencies) < latency_min_samples:
+            return backoff_interval
+        return statistics.median(self.latencies)
+
+    def release(self, latency: float, throttled: bool = False):
+        """
+        free the in flight slot, and adjust the in flight limit by the outcome of the request
+        """
+        with self.locked():
+            self.add_in_flight(-1)
+
+            now = time.time()
+            tokens, last, limit, errors, backoff_at = header.unpack_from(self.map, 0)
+            limit = self.current_limit(limit)
+            errors = errors * (1 - error_alpha) + (error_alpha if throttled else 0)
+
+            if throttled:
+                if now - backoff_at >= self.round_trip():
+                    limit = max(self.min_inflight, limit * self.backoff)
+                    backoff_at = now
+            elif not self.latency_inflated(latency):
+                limit = min(self.inflight, limit + 1 / limit)
+
+            header.pack_into(self.map, 0, tokens, last, limit, errors, backoff_at)
+
+    def stats(self):
+        """
+        (current in flight limit, throttled rate of the recent requests)
+        """
+        with self.locked():
+            _, _, limit, errors, _ = header.unpack_from(self.map, 0)
+            return self.current_limit(limit), errors
+
+    def request(self):
+        return ProviderRequest(self)
+
+
+class ProviderRequest(object):
+    """
+    one request to the provider, it waits for a token and an in flight slot, and reports
+    its latency and whether it was throttled to the limiter when done
+    """
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+        self.throttled = False
+        self.start = None
+        self.context_token = None
+
+    async def __aenter__(self):
+        while (wait := self.limiter.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+        self.start = time.time()
+        self.context_token = current_request.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        current_request.reset(self.context_token)
+        if exc is not None and is_throttled(exc):
+            self.throttled = True
+        self.limiter.release(time.time() - self.start, self.throttled)
+
+
+def get_rate_limiter(provider: Provider):
+    """
+    the limiter of provider configured in rate_limits, None for the providers without limits
+    """
+    limits = findy_config.get('rate_limits', {}).get(provider.value)
+    if not limits:
+        return None
+
+    limiter = __rate_limiters.get(provider)
+    # a forked process shares the flock of the parent's descriptor, reopen it
+    if limiter is None or limiter.pid != os.getpid():
+        limiter = RateLimiter(provider.value,
+                              rate=limits['rate'],
+                              burst=limits.get('burst', 1),
+                              inflight=limits.get('inflight', 1),
+                              min_inflight=limits.get('min_inflight', 1),
+                              backoff=limits.get('backoff', 0.5),
+                              latency_tolerance=limits.get('latency_tolerance', 3.0))
+        __rate_limiters[provider] = limiter
+    return limiter
+
+
+def provider_request(provider: Provider):
+    """
+    the context of one request to provider, within its limits, a no-op for the providers without limits
+    """
+    limiter = get_rate_limiter(provider)
+    return limiter.request() if limiter is not None else contextlib.nullcontext()
+
+
+def get_provider_executor(provider: Provider) -> ThreadPoolExecutor:
+    """
+    the thread pool running the blocking sdk calls of provider, sized to the requests it may have in flight,
+    or to threads in rate_limits for the sdks which are not thread safe
+    """
+    pid, executor = __provider_executors.get(provider, (None, None))
+    # the threads are not forked along with the process
+    if executor is None or pid != os.getpid():
+        limits = findy_config.get('rate_limits', {}).get(provider.value) or {}
+        threads = limits.get('threads', limits.get('inflight', default_threads))
+        executor = ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix=f'{provider.value}_sdk')
+        __provider_executors[provider] = (os.getpid(), executor)
+    return executor
@@ -54,6 +54,10 @@ class ProgressBarProcess():
                     pbar = pbars[task]
 
                 if pfinish.get(task, None) is None:
+                    # in flight limit and error rate of the provider
+                    postfix = data.get('postfix', None)
+                    if postfix is not None:
+                        pbar.set_postfix_str(postfix, refresh=False)
                     pbar.update(data['update'])
 
             time.sleep(sleep)
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import logging
 from http import client
 from retrying import retry
 
 import requests
 from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from findy import findy_config
 # from aiohttp_client_cache import CachedSession, SQLiteBackend
 
 # from findy.utils.cache import hashable_lru
@@ -17,6 +20,9 @@ client.HTTPConnection._http_vsn_str = 'HTTP/1.1'
 http_timeout = (20, 60)
 max_retries = 3
 
+# (event loop, keep-alive session) shared by all the recorders running on the loop of this worker
+__worker_session = (None, None)
+
 
 class TimeoutRequestsSession(requests.Session):
     def request(self, *args, **kwargs):
@@ -58,6 +64,50 @@ def get_async_http_session():
                          )
 
 
+def get_worker_http_session() -> ClientSession:
+    """
+    the keep-alive session of the running event loop, created on first use and reused by every
+    entity and recorder of the worker, so connections, TLS sessions and dns lookups are pooled
+    across them, don't close it, close_worker_http_session does when the worker exits
+    """
+    global __worker_session
+
+    loop = asyncio.get_running_loop()
+    session_loop, session = __worker_session
+    if session is not None and session_loop is loop and not session.closed:
+        return session
+
+    connector = TCPConnector(limit=findy_config.get('http_limit', 100),
+                             limit_per_host=findy_config.get('http_limit_per_host', 10),
+                             ttl_dns_cache=findy_config.get('http_dns_ttl', 300),
+                             keepalive_timeout=findy_config.get('http_keepalive', 30),
+                             ssl=False,
+                             enable_cleanup_closed=True)
+    session = ClientSession(connector=connector,
+                            trust_env=True,
+                            headers={'Accept-Encoding': 'gzip, deflate'},
+                            auto_decompress=True,
+                            timeout=ClientTimeout(total=None, sock_connect=20, sock_read=60))
+    __worker_session = (loop, session)
+    return session
+
+
+async def close_worker_http_session():
+    """
+    close the keep-alive session of the running event loop, waiting for the connections to shut down
+    """
+    global __worker_session
+
+    session_loop, session = __worker_session
+    __worker_session = (None, None)
+    if session is None or session.closed or session_loop is not asyncio.get_running_loop():
+        return
+
+    await session.close()
+    # let the underlying ssl transports close
+    await asyncio.sleep(0.25)
+
+
 def sync_get(http_session: requests.Session, url, headers=None, encoding='utf-8', params={}, enable_proxy=False, return_type=None):
 
     @retry(retry_on_exception=retry_if_connection_error, stop_max_attempt_number=max_retries, wait_fixed=2000)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from findy.database.pgcopy import encode_column
+
+
+class BoolEncodeTest(unittest.TestCase):
+    def decode(self, series: pd.Series):
+        lengths, data = encode_column(series, 'bool')
+        values = iter(data.tolist())
+        return [None if length == -1 else bool(next(values)) for length in lengths]
+
+    def test_bool_column(self):
+        series = pd.Series([True, False, True])
+        self.assertEqual(self.decode(series), [True, False, True])
+
+    def test_object_column_of_string_booleans(self):
+        series = pd.Series(['True', 'False', '0', '1', 't', 'f', 'yes', 'OFF', '', None, np.nan, True, 0],
+                           dtype=object)
+        self.assertEqual(self.decode(series),
+                         [True, False, False, True, True, False, True, False, None, None, None, True, False])
+
+    def test_object_column_rejects_other_values(self):
+        for value in ['maybe', 2, 'nan']:
+            with self.assertRaises(ValueError):
+                encode_column(pd.Series(['true', value], dtype=object), 'bool')
+
+
+if __name__ == '__main__':
+    unittest.main()